@@ -1,136 +1,331 @@
+import atexit
 import logging
 import os
+import sys
 import asyncio
-from datetime import datetime, time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from datetime import date, datetime, time
+from time import strftime
+from io import BytesIO
+from pathlib import Path
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.error import TelegramError, TimedOut
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, AIORateLimiter
 from telegram._message import Message
-from src.config import TELEGRAM_BOT_TOKEN, ALLOWED_CHAT_IDS, YANDEX_FOLDER_ID, ADMIN_USER_IDS
+from telegram.request import HTTPXRequest
+from src.config import (
+    TELEGRAM_BOT_TOKEN, ALLOWED_CHAT_IDS, YANDEX_FOLDER_ID, ADMIN_USER_IDS,
+    PUBLIC_URL, WEBHOOK_SECRET, PORT, USE_POLLING, GPT_WORKERS, GPT_QUEUE_SIZE,
+    GPT_MAX_CONCURRENCY
+)
 from src.yandex_gpt import YandexGPT
 from src.file_handler import FileHandler
+from src.gpt_cache import LRUCache
 from telegram import PhotoSize
-import json
+import orjson
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Настройка логирования: один обработчик с заранее созданным форматтером;
+# явный datefmt избавляет от дописывания миллисекунд к каждой записи
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+))
+root_logger = logging.getLogger()
+root_logger.addHandler(log_handler)
+root_logger.setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Инициализация обработчика файлов
 file_handler = FileHandler(team_name="LAM")
+# Документы Word сохраняются пачками: остаток дописывается и при выходе мимо post_shutdown
+# (исключение при запуске, sys.exit). SIGINT/SIGTERM PTB сам доводит до post_shutdown
+atexit.register(file_handler.flush_documents)
 
 # Инициализация YandexGPT
-gpt = YandexGPT('service-account-key.json', YANDEX_FOLDER_ID)
+gpt = YandexGPT('service-account-key.json', YANDEX_FOLDER_ID, max_concurrency=GPT_MAX_CONCURRENCY)
 
-# Глобальная переменная для хранения чата для отправки отчетов
-report_chat_id = None
+# Ежедневный отчет - задача JobQueue с этим именем; чат хранится в самой задаче.
+# Время отправки задается в часовом поясе сервера.
+DAILY_REPORT_JOB = "daily_report"
+REPORT_TZ = datetime.now().astimezone().tzinfo
 # Переменная для хранения времени отправки отчетов
-report_time = time(7, 0)  # По умолчанию 7:00
-# Флаг статуса автоматической отправки отчетов
-auto_report_enabled = False
+report_time = time(7, 0, tzinfo=REPORT_TZ)  # По умолчанию 7:00
+
+# Очередь текстовых сообщений на анализ YandexGPT и ее обработчики (создаются в post_init)
+message_queue = None
+gpt_workers = []
+# Сколько секунд при остановке ждать обработки уже принятых в очередь сообщений
+SHUTDOWN_DRAIN_TIMEOUT = 60
+
+# Отложенная пересборка Excel: сообщения только помечают данные измененными,
+# а книга пересобирается одной фоновой задачей не чаще раза в EXCEL_DEBOUNCE секунд
+EXCEL_DEBOUNCE = 2.0
+# Отдельный пул потоков для сборки Excel (openpyxl, чтение docx): сборка длится секунды
+# и не должна занимать потоки пула по умолчанию, через который идут запись сообщений
+# в Word, кэш анализа, IAM и разрешение имен для HTTP-клиентов
+EXCEL_THREADS = 2
+excel_executor = ThreadPoolExecutor(max_workers=EXCEL_THREADS, thread_name_prefix="excel")
+excel_dirty = None
+excel_writer_task = None
+
+# Дата для подписей отчетов, пересчитывается раз в сутки
+_today_cache = {"date": None, "str": ""}
+
+# Результаты анализа фотографий по file_unique_id: повторно присланное фото
+# не скачивается и не отправляется в YandexGPT
+photo_cache = LRUCache(maxsize=256)
+
+# Последний сформированный Excel-файл и версия данных, по которой он построен
+_excel_cache = {"version": None, "bytes": None, "path": None}
+# Книга собирается одним обработчиком за раз: параллельные сборки писали бы в один
+# и тот же файл отчета и делили состояние FileHandler
+_excel_lock = asyncio.Lock()
+
+# Фоновые задачи (ответы об ошибках); ссылки держим, чтобы задачи не собрал GC
+background_tasks = set()
+
+# Типы обновлений, которые бот действительно обрабатывает: сообщения (текст, фото,
+# команды) и нажатия инлайн-кнопок. Остальные Telegram не присылает вовсе.
+# Кортеж собирается один раз при импорте и не меняется
+ALLOWED_UPDATES = (Update.MESSAGE, Update.CALLBACK_QUERY)
+
+# Обычный текст без команд; составной фильтр собирается один раз при импорте
+TEXT_NO_CMD = filters.TEXT & ~filters.COMMAND
+
+# Тексты ответов бота
+START_TEXT = (
+    "Привет! Я бот для обработки сообщений от агрономов. "
+    "Я буду сохранять все сообщения, анализировать их с помощью YandexGPT и сохранять в Excel.\n\n"
+    "📝 ВАЖНО: После каждого полученного сообщения я автоматически обновляю Excel-таблицу!\n\n"
+    "Доступные команды:\n"
+    "/help - показать эту справку\n"
+    "/export - экспортировать данные в Excel в формате для агрономов\n"
+    "/stats - показать статистику обработанных сообщений\n"
+    "/schedule - настроить автоматическую отправку отчетов"
+)
+
+HELP_TEXT = (
+    "🤖 Я - бот для обработки сельскохозяйственных данных!\n\n"
+    "📝 *Как пользоваться:*\n"
+    "1. Просто напишите мне сообщение с данными в свободной форме\n"
+    "2. Я проанализирую его с помощью ИИ и добавлю в базу данных\n"
+    "3. Вы можете скачать отчет Excel в любой момент\n\n"
+    "🔍 *Формат сообщений:*\n"
+    "• Укажите тип работы (Пахота, Дискование и т.д.)\n"
+    "• Данные ПУ в формате: `По Пу 123/456`\n"
+    "• Данные отделов: `Отд 12 123/456`\n\n"
+    "📊 *Команды:*\n"
+    "/start - Запуск бота\n"
+    "/help - Показать эту справку\n"
+    "/export - Экспортировать данные в Excel\n"
+    "/stats - Показать статистику обработанных сообщений\n"
+    "/schedule - Настроить автоматическую отправку отчетов\n"
+    "/reset - Очистить все данные и начать с чистого листа (только для админов)\n\n"
+    "📱 Бот разработан командой Lenin Agro Monitor"
+)
+
+PROCESSING_TEXT = "🔄 Обрабатываю сообщение с помощью YandexGPT и обновляю Excel-таблицу..."
+QUEUE_FULL_TEXT = "⏳ Сейчас слишком много сообщений в обработке. Пожалуйста, отправьте сообщение чуть позже."
+MESSAGE_ACK_TEXT = "✅ Сообщение получено, обработано YandexGPT и добавлено в Excel-таблицу\n\n"
+EXCEL_UPDATED_TEXT = "\n📊 Excel-таблица автоматически обновлена с использованием анализа YandexGPT!"
+DUPLICATE_SKIPPED_TEXT = "ℹ️ Такое сообщение от вас уже получено недавно - повтор не добавлен в отчет."
+
+# Статические клавиатуры создаются один раз. Значения callback_data разбирает
+# button_handler, поэтому их нельзя менять без правки BUTTON_HANDLERS: кнопки
+# в уже отправленных сообщениях продолжают присылать старые значения.
+EXPORT_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Экспортировать в Excel", callback_data="export_excel")]
+])
+DOWNLOAD_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Скачать текущий Excel-файл", callback_data="export_excel")]
+])
+SCHEDULE_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("6:00", callback_data="schedule_time_6"),
+        InlineKeyboardButton("7:00", callback_data="schedule_time_7"),
+        InlineKeyboardButton("8:00", callback_data="schedule_time_8")
+    ],
+    [
+        InlineKeyboardButton("Включить автоотправку", callback_data="schedule_enable"),
+        InlineKeyboardButton("Выключить автоотправку", callback_data="schedule_disable")
+    ],
+    [
+        InlineKeyboardButton("Отправить отчет сейчас", callback_data="send_report_now")
+    ]
+])
+
+# Поля результата анализа для ответа пользователю: (ключи, шаблон строки).
+# Строка выводится, только если заполнены все ключи.
+OPERATION_FIELDS = (
+    (("work_type",), "🚜 Тип работы: {}\n"),
+    (("operation",), "📝 Операция: {}\n"),
+    (("culture_from",), "🌱 Исходная культура: {}\n"),
+    (("culture_to",), "🌾 Целевая культура: {}\n"),
+    (("department",), "🏢 Отдел: {}\n"),
+    (("department_number", "department_area"), "📊 Номер/площадь отдела: {}/{}\n"),
+    (("pu_number", "pu_area"), "🔢 ПУ номер/площадь: {}/{}\n"),
+)
+# Для одиночной записи операция отдельной строкой не выводится
+DATA_FIELDS = tuple(field for field in OPERATION_FIELDS if field[0] != ("operation",))
+
+# Поля анализа фотографии: строка выводится, если заполнен первый ключ
+PHOTO_FIELDS = (
+    (("work_type",), "🚜 Тип работы: {}\n"),
+    (("operation",), "📝 Операция: {}\n"),
+    (("culture_to",), "🌾 Культура: {}\n"),
+    (("pu_number", "pu_area"), "🔢 ПУ: {}/{}\n"),
+    (("department", "department_number", "department_area"), "🏢 Отдел: {} {}/{}\n"),
+    (("quality",), "⭐ Качество работы: {}\n"),
+    (("field_condition",), "🌱 Состояние поля: {}\n"),
+    (("issues",), "⚠️ Проблемы: {}\n"),
+)
+
+# Токен длинный: тексты короче него пропускаются без поиска подстроки
+TOKEN_LEN = len(TELEGRAM_BOT_TOKEN)
 
 def mask_token(text: str) -> str:
     """Маскирует токен бота в тексте для безопасного логирования"""
-    if TELEGRAM_BOT_TOKEN in text:
-        return text.replace(TELEGRAM_BOT_TOKEN, "***TOKEN***")
-    return text
+    if len(text) < TOKEN_LEN:
+        return text
+    return text.replace(TELEGRAM_BOT_TOKEN, "***TOKEN***")
+
+# Пустой список разрешенных чатов означает, что бот работает во всех чатах
+ALLOW_ALL_CHATS = not ALLOWED_CHAT_IDS
+
+async def _safe_reply(message: Message, text: str):
+    """Отвечает на сообщение, не пробрасывая ошибки отправки"""
+    try:
+        await message.reply_text(text)
+    except Exception as e:
+        logger.warning("Не удалось отправить ответ об ошибке в чат %s: %s", message.chat_id, e)
+
+def reply_in_background(message: Message, text: str):
+    """Отправляет ответ отдельной задачей, не задерживая обработчик"""
+    task = asyncio.create_task(_safe_reply(message, text))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+def build_excel():
+    """Пересобирает Excel-отчет и читает его с диска (блокирующая операция)"""
+    excel_path = file_handler.update_excel()
+    return excel_path, Path(excel_path).read_bytes()
+
+async def get_current_excel_bytes():
+    """Возвращает актуальный Excel-отчет в памяти и путь к нему.
+    
+    Книга пересобирается только если данные изменились с прошлого экспорта.
+    """
+    async with _excel_lock:
+        # Версия проверяется под блокировкой: пока ждали, книгу мог собрать другой обработчик
+        version = file_handler.data_version
+        if _excel_cache["version"] != version:
+            excel_path, excel_bytes = await asyncio.get_running_loop().run_in_executor(excel_executor, build_excel)
+            _excel_cache["bytes"] = excel_bytes
+            _excel_cache["path"] = excel_path
+            _excel_cache["version"] = version
+        return BytesIO(_excel_cache["bytes"]), _excel_cache["path"]
+
+def save_photo(file_path: str, image_bytes: bytes):
+    """Сохраняет архивную копию фотографии на диск"""
+    try:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        Path(file_path).write_bytes(image_bytes)
+    except OSError as e:
+        logger.warning("Не удалось сохранить фото %s: %s", file_path, e)
+
+async def send_excel(send_document, caption: str) -> str:
+    """Отправляет актуальный Excel-отчет и возвращает путь к нему.
+    
+    send_document - метод отправки документа: Message.reply_document или
+    Bot.send_document с уже подставленным chat_id.
+    """
+    excel_file, excel_path = await get_current_excel_bytes()
+    await send_document(
+        document=excel_file,
+        filename=os.path.basename(excel_path),
+        caption=caption
+    )
+    return excel_path
+
+def purge_dir(path: str, suffix: str) -> int:
+    """Удаляет из каталога файлы с заданным расширением, возвращает их количество"""
+    count = 0
+    if not os.path.isdir(path):
+        return count
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith(suffix) and entry.is_file():
+                os.unlink(entry.path)
+                count += 1
+    return count
+
+def today_str() -> str:
+    """Возвращает сегодняшнюю дату в формате ДД.ММ.ГГГГ"""
+    today = date.today()
+    if _today_cache["date"] != today:
+        _today_cache["date"] = today
+        _today_cache["str"] = today.strftime('%d.%m.%Y')
+    return _today_cache["str"]
+
+def append_fields(parts: list, data: dict, fields: tuple, indent: str = ""):
+    """Добавляет в parts строки для заполненных полей data по таблице шаблонов"""
+    append = parts.append
+    for keys, template in fields:
+        values = [data.get(key) for key in keys]
+        if all(values):
+            append(indent + template.format(*values))
 
 def is_allowed_chat(chat_id: int) -> bool:
     """Проверка, разрешен ли чат для работы бота"""
-    return not ALLOWED_CHAT_IDS or chat_id in ALLOWED_CHAT_IDS
+    return ALLOW_ALL_CHATS or chat_id in ALLOWED_CHAT_IDS
 
 async def check_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Проверяет, является ли пользователь администратором бота"""
-    user_id = update.effective_user.id
-    if not ADMIN_USER_IDS or user_id not in ADMIN_USER_IDS:
+    user = update.effective_user
+    if not ADMIN_USER_IDS or user.id not in ADMIN_USER_IDS:
         await update.message.reply_text(
             "❌ У вас нет прав администратора для выполнения этой команды."
         )
-        logger.warning(f"Попытка доступа к административной команде от пользователя {update.effective_user.username} (ID: {user_id})")
+        logger.warning("Попытка доступа к административной команде от пользователя %s (ID: %s)", user.username, user.id)
         return False
     return True
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
-    if not is_allowed_chat(update.effective_chat.id):
-        logger.warning(f"Попытка доступа из неразрешенного чата {update.effective_chat.id}")
-        return
-    
-    await update.message.reply_text(
-        "Привет! Я бот для обработки сообщений от агрономов. "
-        "Я буду сохранять все сообщения, анализировать их с помощью YandexGPT и сохранять в Excel.\n\n"
-        "📝 ВАЖНО: После каждого полученного сообщения я автоматически обновляю Excel-таблицу!\n\n"
-        "Доступные команды:\n"
-        "/help - показать эту справку\n"
-        "/export - экспортировать данные в Excel в формате для агрономов\n"
-        "/stats - показать статистику обработанных сообщений\n"
-        "/schedule - настроить автоматическую отправку отчетов"
-    )
+    await update.message.reply_text(START_TEXT)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет справку о командах бота"""
-    if not is_allowed_chat(update.effective_chat.id):
-        logger.warning(f"Попытка доступа из неразрешенного чата {update.effective_chat.id}")
-        return
-        
-    help_text = (
-        "🤖 Я - бот для обработки сельскохозяйственных данных!\n\n"
-        "📝 *Как пользоваться:*\n"
-        "1. Просто напишите мне сообщение с данными в свободной форме\n"
-        "2. Я проанализирую его с помощью ИИ и добавлю в базу данных\n"
-        "3. Вы можете скачать отчет Excel в любой момент\n\n"
-        "🔍 *Формат сообщений:*\n"
-        "• Укажите тип работы (Пахота, Дискование и т.д.)\n"
-        "• Данные ПУ в формате: `По Пу 123/456`\n"
-        "• Данные отделов: `Отд 12 123/456`\n\n"
-        "📊 *Команды:*\n"
-        "/start - Запуск бота\n"
-        "/help - Показать эту справку\n"
-        "/export - Экспортировать данные в Excel\n"
-        "/stats - Показать статистику обработанных сообщений\n"
-        "/schedule - Настроить автоматическую отправку отчетов\n"
-        "/reset - Очистить все данные и начать с чистого листа (только для админов)\n\n"
-        "📱 Бот разработан командой Lenin Agro Monitor"
-    )
-    await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(HELP_TEXT, parse_mode=ParseMode.MARKDOWN)
 
 async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /export"""
-    if not is_allowed_chat(update.effective_chat.id):
-        logger.warning(f"Попытка доступа из неразрешенного чата {update.effective_chat.id}")
-        return
-    
-    await update.message.reply_text("Экспортирую данные в Excel в стандартном формате для отчетности...")
+    message = update.message
+    await message.reply_text("Экспортирую данные в Excel в стандартном формате для отчетности...")
     
     try:
-        # Обновляем Excel файл
-        excel_path = file_handler.update_excel()
-        
-        # Отправляем файл пользователю
-        await update.message.reply_document(
-            document=open(excel_path, 'rb'),
-            caption=(
+        # Отправляем актуальный Excel файл пользователю
+        excel_path = await send_excel(
+            message.reply_document,
+            (
                 "Данные успешно экспортированы в Excel. Таблица содержит колонки: "
                 "Дата, Подразделение, Операция, Культура, За день (га), С начала операции (га), Вал за день (ц), Вал с начала (ц).\n\n"
                 "⚠️ ПРИМЕЧАНИЕ: Ячейки с желтой подсветкой содержат данные, которые не удалось точно идентифицировать."
             )
         )
         
-        logger.info(f"Данные экспортированы в файл: {excel_path}")
+        logger.info("Данные экспортированы в файл: %s", excel_path)
         
     except Exception as e:
-        logger.error(f"Ошибка при экспорте данных: {e}")
-        await update.message.reply_text(f"Произошла ошибка при экспорте данных: {str(e)}")
+        logger.error("Ошибка при экспорте данных: %s", e)
+        await message.reply_text(f"Произошла ошибка при экспорте данных: {str(e)}")
 
 async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /stats"""
-    if not is_allowed_chat(update.effective_chat.id):
-        logger.warning(f"Попытка доступа из неразрешенного чата {update.effective_chat.id}")
-        return
-    
+    message = update.message
     try:
         # Получаем статистику
         stats = file_handler.get_statistics()
@@ -155,300 +350,276 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Сообщения сохранены в директории: {file_handler.messages_path}{last_excel_info}"
         )
         
-        # Добавляем кнопку для экспорта в Excel
-        keyboard = [
-            [InlineKeyboardButton("Экспортировать в Excel", callback_data="export_excel")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(stats_message, reply_markup=reply_markup)
+        await message.reply_text(stats_message, reply_markup=EXPORT_KB)
         
     except Exception as e:
-        logger.error(f"Ошибка при получении статистики: {e}")
-        await update.message.reply_text(f"Произошла ошибка при получении статистики: {str(e)}")
+        logger.error("Ошибка при получении статистики: %s", e)
+        await message.reply_text(f"Произошла ошибка при получении статистики: {str(e)}")
+
+def schedule_daily_report(job_queue, chat_id: int):
+    """Ставит (или переставляет) ежедневную отправку отчета в чат на report_time"""
+    cancel_daily_report(job_queue)
+    job_queue.run_daily(send_scheduled_report, time=report_time, name=DAILY_REPORT_JOB, chat_id=chat_id)
+
+def cancel_daily_report(job_queue):
+    """Снимает ежедневную отправку отчета"""
+    for job in job_queue.get_jobs_by_name(DAILY_REPORT_JOB):
+        job.schedule_removal()
+
+def auto_report_status(job_queue) -> str:
+    """Статус автоотправки для сообщений пользователю"""
+    return "включена" if job_queue.get_jobs_by_name(DAILY_REPORT_JOB) else "выключена"
 
 async def schedule_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /schedule"""
-    if not is_allowed_chat(update.effective_chat.id):
-        logger.warning(f"Попытка доступа из неразрешенного чата {update.effective_chat.id}")
-        return
-    
-    global report_chat_id, auto_report_enabled
-    
-    # Сохраняем ID чата для отправки отчетов
-    report_chat_id = update.effective_chat.id
-    
-    # Создаем клавиатуру с настройками времени
-    keyboard = [
-        [
-            InlineKeyboardButton("6:00", callback_data="schedule_time_6"),
-            InlineKeyboardButton("7:00", callback_data="schedule_time_7"),
-            InlineKeyboardButton("8:00", callback_data="schedule_time_8")
-        ],
-        [
-            InlineKeyboardButton("Включить автоотправку", callback_data="schedule_enable"),
-            InlineKeyboardButton("Выключить автоотправку", callback_data="schedule_disable")
-        ],
-        [
-            InlineKeyboardButton("Отправить отчет сейчас", callback_data="send_report_now")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    status = "включена" if auto_report_enabled else "выключена"
+    status = auto_report_status(context.job_queue)
     
     await update.message.reply_text(
         f"Настройка автоматической отправки отчетов.\n\n"
         f"Текущее время отправки: {report_time.hour}:00\n"
         f"Статус автоотправки: {status}\n"
         f"Выберите новое время или настройки:",
-        reply_markup=reply_markup
+        reply_markup=SCHEDULE_KB
     )
 
-async def send_scheduled_report():
-    """Отправляет запланированный отчет"""
-    global report_chat_id
-    
-    if not report_chat_id or not auto_report_enabled:
-        logger.info("Автоматическая отправка отчетов отключена или не настроена")
-        return
+async def send_scheduled_report(context: ContextTypes.DEFAULT_TYPE):
+    """Отправляет запланированный отчет (вызывается JobQueue)"""
+    chat_id = context.job.chat_id
     
     try:
-        # Обновляем Excel файл
-        excel_path = file_handler.update_excel()
-        
-        # Отправляем файл в указанный чат
-        await context.bot.send_document(
-            chat_id=report_chat_id,
-            document=open(excel_path, 'rb'),
-            caption=f"Автоматический отчет за {datetime.now().strftime('%d.%m.%Y')}"
+        # Отправляем актуальный Excel файл в указанный чат
+        await send_excel(
+            partial(context.bot.send_document, chat_id),
+            f"Автоматический отчет за {today_str()}"
         )
         
-        logger.info(f"Автоматический отчет отправлен в чат {report_chat_id}")
+        logger.info("Автоматический отчет отправлен в чат %s", chat_id)
         
     except Exception as e:
-        logger.error(f"Ошибка при отправке автоматического отчета: {e}")
-        if report_chat_id:
-            await context.bot.send_message(
-                chat_id=report_chat_id,
-                text=f"Ошибка при отправке автоматического отчета: {str(e)}"
-            )
+        logger.error("Ошибка при отправке автоматического отчета: %s", e)
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"Ошибка при отправке автоматического отчета: {str(e)}"
+        )
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий на кнопки"""
-    query = update.callback_query
-    await query.answer()
-    
-    global report_time, auto_report_enabled
+async def export_excel_button(query, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка «Экспортировать в Excel»: отправляет актуальный отчет"""
+    await query.edit_message_text(text="Экспортирую данные в Excel в стандартном формате...")
     
-    if query.data == "export_excel":
-        await query.edit_message_text(text="Экспортирую данные в Excel в стандартном формате...")
+    try:
+        # Отправляем актуальный Excel файл пользователю
+        excel_path = await send_excel(
+            query.message.reply_document,
+            "Данные успешно экспортированы в Excel в стандартном формате АОР. Ячейки с желтой подсветкой содержат данные, которые не удалось точно идентифицировать."
+        )
         
-        try:
-            # Обновляем Excel файл
-            excel_path = file_handler.update_excel()
-            
-            # Отправляем файл пользователю
-            await query.message.reply_document(
-                document=open(excel_path, 'rb'),
-                caption="Данные успешно экспортированы в Excel в стандартном формате АОР. Ячейки с желтой подсветкой содержат данные, которые не удалось точно идентифицировать."
-            )
-            
-            await query.edit_message_text(text="Данные успешно экспортированы в Excel")
-            logger.info(f"Данные экспортированы в файл: {excel_path}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка при экспорте данных: {e}")
-            await query.edit_message_text(text=f"Произошла ошибка при экспорте данных: {str(e)}")
+        await query.edit_message_text(text="Данные успешно экспортированы в Excel")
+        logger.info("Данные экспортированы в файл: %s", excel_path)
+        
+    except Exception as e:
+        logger.error("Ошибка при экспорте данных: %s", e)
+        await query.edit_message_text(text=f"Произошла ошибка при экспорте данных: {str(e)}")
+
+async def schedule_time_button(query, context: ContextTypes.DEFAULT_TYPE, hour: int):
+    """Кнопки выбора часа: устанавливают время отправки отчетов"""
+    global report_time
+    report_time = time(hour, 0, tzinfo=REPORT_TZ)
     
-    elif query.data.startswith("schedule_time_"):
-        # Устанавливаем время отправки отчетов
-        hour = int(query.data.split("_")[-1])
-        report_time = time(hour, 0)
-        
-        status = "включена" if auto_report_enabled else "выключена"
-        await query.edit_message_text(
-            f"Время отправки отчетов установлено на {hour}:00\n"
-            f"Статус автоотправки: {status}"
-        )
+    # Включенную автоотправку переносим на новое время
+    jobs = context.job_queue.get_jobs_by_name(DAILY_REPORT_JOB)
+    if jobs:
+        schedule_daily_report(context.job_queue, jobs[0].chat_id)
     
-    elif query.data == "schedule_enable":
-        # Включаем автоматическую отправку отчетов
-        auto_report_enabled = True
-        await query.edit_message_text(
-            f"Автоматическая отправка отчетов включена.\n"
-            f"Время отправки: {report_time.hour}:00"
-        )
+    status = auto_report_status(context.job_queue)
+    await query.edit_message_text(
+        f"Время отправки отчетов установлено на {hour}:00\n"
+        f"Статус автоотправки: {status}"
+    )
+
+async def schedule_enable_button(query, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка включения автоматической отправки отчетов в текущий чат"""
+    schedule_daily_report(context.job_queue, query.message.chat_id)
+    await query.edit_message_text(
+        f"Автоматическая отправка отчетов включена.\n"
+        f"Время отправки: {report_time.hour}:00"
+    )
+
+async def schedule_disable_button(query, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка выключения автоматической отправки отчетов"""
+    cancel_daily_report(context.job_queue)
+    await query.edit_message_text(
+        f"Автоматическая отправка отчетов выключена."
+    )
+
+async def send_report_now_button(query, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка «Отправить отчет сейчас»"""
+    await query.edit_message_text(text="Отправляю отчет...")
     
-    elif query.data == "schedule_disable":
-        # Выключаем автоматическую отправку отчетов
-        auto_report_enabled = False
-        await query.edit_message_text(
-            f"Автоматическая отправка отчетов выключена."
+    try:
+        # Отправляем актуальный Excel файл пользователю
+        await send_excel(
+            query.message.reply_document,
+            f"Отчет за {today_str()}"
         )
+        
+        await query.edit_message_text(text="Отчет успешно отправлен")
+        logger.info("Отчет отправлен вручную")
+        
+    except Exception as e:
+        logger.error("Ошибка при отправке отчета: %s", e)
+        await query.edit_message_text(text=f"Произошла ошибка при отправке отчета: {str(e)}")
+
+# Обработчики кнопок по значению callback_data
+BUTTON_HANDLERS = {
+    "export_excel": export_excel_button,
+    "schedule_enable": schedule_enable_button,
+    "schedule_disable": schedule_disable_button,
+    "send_report_now": send_report_now_button,
+}
+SCHEDULE_TIME_PREFIX = "schedule_time_"
+SCHEDULE_TIME_PREFIX_LEN = len(SCHEDULE_TIME_PREFIX)
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик нажатий на кнопки"""
+    query = update.callback_query
+    await query.answer()
     
-    elif query.data == "send_report_now":
-        # Отправляем отчет немедленно
-        await query.edit_message_text(text="Отправляю отчет...")
+    data = query.data
+    handler = BUTTON_HANDLERS.get(data)
+    if handler is not None:
+        await handler(query, context)
+    elif data[:SCHEDULE_TIME_PREFIX_LEN] == SCHEDULE_TIME_PREFIX:
+        await schedule_time_button(query, context, int(data[SCHEDULE_TIME_PREFIX_LEN:]))
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик текстовых сообщений: подтверждает прием и ставит сообщение в очередь анализа"""
+    message = update.message
+    try:
+        if logger.isEnabledFor(logging.INFO):
+            sender_name = message.from_user.first_name or "Unknown"
+            logger.info("Получено сообщение от %s: %s...", sender_name, mask_token(message.text[:50]))
+        
+        # Отправляем сообщение "обрабатываю..."
+        process_message = await message.reply_text(PROCESSING_TEXT)
         
+        # Анализ YandexGPT выполняют обработчики очереди, чтобы не занимать цикл обновлений
         try:
-            # Обновляем Excel файл
-            excel_path = file_handler.update_excel()
-            
-            # Отправляем файл пользователю
-            await query.message.reply_document(
-                document=open(excel_path, 'rb'),
-                caption=f"Отчет за {datetime.now().strftime('%d.%m.%Y')}"
-            )
+            message_queue.put_nowait((message, process_message))
+        except asyncio.QueueFull:
+            logger.warning("Очередь анализа переполнена, сообщение отклонено")
+            await process_message.edit_text(QUEUE_FULL_TEXT)
             
-            await query.edit_message_text(text="Отчет успешно отправлен")
-            logger.info(f"Отчет отправлен вручную")
-            
-        except Exception as e:
-            logger.error(f"Ошибка при отправке отчета: {e}")
-            await query.edit_message_text(text=f"Произошла ошибка при отправке отчета: {str(e)}")
+    except TimedOut:
+        # Таймаут сети передаем PTB, он залогирует его сам
+        raise
+    except TelegramError as e:
+        # Ответить в чат при ошибке Telegram API, скорее всего, тоже не получится
+        logger.warning("Ошибка Telegram API при приеме сообщения из чата %s: %s", message.chat_id, e)
+    except Exception as e:
+        logger.exception("Необработанная ошибка при приеме сообщения из чата %s", message.chat_id)
+        reply_in_background(message, f"Произошла ошибка при обработке сообщения: {str(e)}")
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик текстовых сообщений"""
-    if not is_allowed_chat(update.effective_chat.id):
-        logger.warning(f"Попытка доступа из неразрешенного чата {update.effective_chat.id}")
-        return
-    
+async def excel_writer_loop():
+    """Пересобирает Excel после пачки сообщений, а не после каждого"""
+    while True:
+        await excel_dirty.wait()
+        await asyncio.sleep(EXCEL_DEBOUNCE)
+        excel_dirty.clear()
+        try:
+            await get_current_excel_bytes()
+        except Exception:
+            logger.exception("Ошибка при автоматическом обновлении Excel")
+
+async def gpt_worker():
+    """Обработчик очереди: анализирует сообщения с YandexGPT и отправляет результат"""
+    while True:
+        message, process_message = await message_queue.get()
+        try:
+            await process_text_message(message, process_message)
+        except Exception:
+            # Обработчик очереди не должен завершаться из-за ошибки в одном сообщении
+            logger.exception("Ошибка в обработчике очереди анализа")
+        finally:
+            message_queue.task_done()
+
+async def process_text_message(message: Message, process_message: Message):
+    """Анализирует текстовое сообщение, сохраняет его и отвечает извлеченными данными"""
     try:
-        # Получаем информацию о сообщении
-        message = update.message
         sender_name = message.from_user.first_name or "Unknown"
         message_text = message.text
         
-        logger.info(f"Получено сообщение от {sender_name}: {mask_token(message_text[:50])}...")
-        
-        # Отправляем сообщение "обрабатываю..."
-        process_message = await message.reply_text("🔄 Обрабатываю сообщение с помощью YandexGPT и обновляю Excel-таблицу...")
-        
         # Сохраняем сообщение в файл и одновременно анализируем его с YandexGPT
         file_path, extracted_data = await file_handler.save_message(sender_name, message_text, gpt)
-        logger.info(f"Сообщение сохранено в файл: {file_path}")
-        
-        # Удаляем сообщение "обрабатываю..."
-        await process_message.delete()
+        if not file_path:
+            # Повтор недавнего сообщения ничего не записал - сообщаем, что он пропущен
+            await process_message.edit_text(DUPLICATE_SKIPPED_TEXT)
+            return
+        logger.info("Сообщение сохранено в файл: %s", file_path)
+        excel_dirty.set()
         
         # Формируем ответ с извлеченными данными
-        response = "✅ Сообщение получено, обработано YandexGPT и добавлено в Excel-таблицу\n\n"
+        parts = [MESSAGE_ACK_TEXT]
+        append = parts.append
         
         if "error" in extracted_data:
             # Используем обычный анализ, если YandexGPT не справился
             extracted_data = file_handler.parse_message(message_text)
-            response += "⚠️ Анализ с помощью YandexGPT не удался, использую базовый анализ.\n\n"
+            append("⚠️ Анализ с помощью YandexGPT не удался, использую базовый анализ.\n\n")
         
-        if "operations" in extracted_data and extracted_data["operations"]:
-            response += f"📋 YandexGPT обнаружил {len(extracted_data['operations'])} операций:\n\n"
+        operations = extracted_data.get("operations")
+        if operations:
+            append(f"📋 YandexGPT обнаружил {len(operations)} операций:\n\n")
             
-            for i, operation in enumerate(extracted_data["operations"], 1):
-                response += f"🔹 Операция #{i}:\n"
-                
-                if "work_type" in operation and operation["work_type"]:
-                    response += f"  🚜 Тип работы: {operation['work_type']}\n"
-                    
-                if "operation" in operation and operation["operation"]:
-                    response += f"  📝 Операция: {operation['operation']}\n"
-                    
-                if "culture_from" in operation and operation["culture_from"]:
-                    response += f"  🌱 Исходная культура: {operation['culture_from']}\n"
-                    
-                if "culture_to" in operation and operation["culture_to"]:
-                    response += f"  🌾 Целевая культура: {operation['culture_to']}\n"
-                    
-                if "department" in operation and operation["department"]:
-                    response += f"  🏢 Отдел: {operation['department']}\n"
-                    
-                if "department_number" in operation and "department_area" in operation:
-                    if operation["department_number"] and operation["department_area"]:
-                        response += f"  📊 Номер/площадь отдела: {operation['department_number']}/{operation['department_area']}\n"
-                    
-                if "pu_number" in operation and "pu_area" in operation:
-                    if operation["pu_number"] and operation["pu_area"]:
-                        response += f"  🔢 ПУ номер/площадь: {operation['pu_number']}/{operation['pu_area']}\n"
-                
-                response += "\n"
-                
-            if "corrections" in extracted_data and extracted_data["corrections"]:
-                response += f"\n⚠️ Исправления: {extracted_data['corrections']}\n"
+            for i, operation in enumerate(operations, 1):
+                append(f"🔹 Операция #{i}:\n")
+                append_fields(parts, operation, OPERATION_FIELDS, "  ")
+                append("\n")
         
         elif extracted_data:
-            response += "📋 Извлеченные данные:\n"
-            
-            if "work_type" in extracted_data and extracted_data["work_type"]:
-                response += f"🚜 Тип работы: {extracted_data['work_type']}\n"
-                
-            if "culture_from" in extracted_data and extracted_data["culture_from"]:
-                response += f"🌱 Исходная культура: {extracted_data['culture_from']}\n"
-                
-            if "culture_to" in extracted_data and extracted_data["culture_to"]:
-                response += f"🌾 Целевая культура: {extracted_data['culture_to']}\n"
-                
-            if "department" in extracted_data and extracted_data["department"]:
-                response += f"🏢 Отдел: {extracted_data['department']}\n"
-                
-            if "department_number" in extracted_data and "department_area" in extracted_data:
-                if extracted_data["department_number"] and extracted_data["department_area"]:
-                    response += f"📊 Номер/площадь отдела: {extracted_data['department_number']}/{extracted_data['department_area']}\n"
-                
-            if "pu_number" in extracted_data and "pu_area" in extracted_data:
-                if extracted_data["pu_number"] and extracted_data["pu_area"]:
-                    response += f"🔢 ПУ номер/площадь: {extracted_data['pu_number']}/{extracted_data['pu_area']}\n"
-                    
-            if "corrections" in extracted_data and extracted_data["corrections"]:
-                response += f"\n⚠️ Исправления: {extracted_data['corrections']}\n"
+            append("📋 Извлеченные данные:\n")
+            append_fields(parts, extracted_data, DATA_FIELDS)
                 
         else:
-            response += "⚠️ Не удалось извлечь структурированные данные из сообщения.\n"
+            append("⚠️ Не удалось извлечь структурированные данные из сообщения.\n")
         
-        # Добавляем сообщение о том, что Excel-файл обновлен автоматически
-        response += "\n📊 Excel-таблица автоматически обновлена с использованием анализа YandexGPT!"
+        if extracted_data.get("corrections"):
+            append(f"\n⚠️ Исправления: {extracted_data['corrections']}\n")
         
-        # Добавляем кнопку для экспорта в Excel
-        keyboard = [
-            [InlineKeyboardButton("Скачать текущий Excel-файл", callback_data="export_excel")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        # Добавляем сообщение о том, что Excel-файл обновлен автоматически
+        append(EXCEL_UPDATED_TEXT)
+        response = "".join(parts)
         
-        # Отправляем подтверждение
-        await message.reply_text(response, reply_markup=reply_markup)
+        # Заменяем сообщение "обрабатываю..." подтверждением с кнопкой экспорта:
+        # один запрос вместо удаления и отправки
+        await process_message.edit_text(response, reply_markup=DOWNLOAD_KB)
             
+    except TelegramError as e:
+        logger.warning("Ошибка Telegram API при ответе в чат %s: %s", message.chat_id, e)
     except Exception as e:
-        logger.error(f"Ошибка при обработке сообщения: {e}")
-        await message.reply_text(f"Произошла ошибка при обработке сообщения: {str(e)}")
+        logger.exception("Необработанная ошибка при обработке сообщения из чата %s", message.chat_id)
+        reply_in_background(message, f"Произошла ошибка при обработке сообщения: {str(e)}")
 
 async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Сбрасывает все данные бота и начинает с чистого листа"""
     if not await check_admin(update, context):
         return
     
+    message = update.message
     try:
         # Очищаем кэш анализа и историю
         result = file_handler.clear_cache_and_history()
+        photo_cache.clear()
         
         # Удаляем все Excel файлы
         excel_dir = os.path.join("data", "excel")
-        excel_files_count = 0
-        if os.path.exists(excel_dir):
-            for file_name in os.listdir(excel_dir):
-                if file_name.endswith(".xlsx"):
-                    os.remove(os.path.join(excel_dir, file_name))
-                    excel_files_count += 1
+        excel_files_count = await asyncio.to_thread(purge_dir, excel_dir, ".xlsx")
         
         # Удаляем все файлы сообщений
         messages_dir = file_handler.messages_path
-        messages_files_count = 0
-        if os.path.exists(messages_dir):
-            for file_name in os.listdir(messages_dir):
-                if file_name.endswith(".docx"):
-                    os.remove(os.path.join(messages_dir, file_name))
-                    messages_files_count += 1
+        messages_files_count = await asyncio.to_thread(purge_dir, messages_dir, ".docx")
         
         # Отправляем сообщение об успешном сбросе
-        await update.message.reply_text(
+        await message.reply_text(
             f"✅ Бот успешно сброшен!\n\n"
             f"🗑️ Удалено:\n"
             f"- {excel_files_count} Excel файлов\n"
@@ -456,42 +627,44 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             f"- Кэш анализа и статистика\n\n"
             f"Теперь анализ будет начат с чистого листа."
         )
-        logging.info(f"Бот сброшен пользователем {update.effective_user.username}. Удалено {excel_files_count} Excel файлов и {messages_files_count} файлов сообщений.")
+        logger.info("Бот сброшен пользователем %s. Удалено %s Excel файлов и %s файлов сообщений.", update.effective_user.username, excel_files_count, messages_files_count)
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка при сбросе бота: {str(e)}")
-        logging.error(f"Ошибка при сбросе бота: {str(e)}")
+        await message.reply_text(f"❌ Ошибка при сбросе бота: {str(e)}")
+        logger.error("Ошибка при сбросе бота: %s", e)
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает входящие фотографии"""
+    message = update.message
     try:
-        # Проверяем разрешен ли чат
-        if not is_allowed_chat(update.effective_chat.id):
-            logger.warning(f"Попытка доступа из неразрешенного чата {update.effective_chat.id}")
-            await update.message.reply_text("Извините, у вас нет доступа к этому боту.")
-            return
-
         # Получаем информацию о фото
-        photo = update.message.photo[-1]  # Берем самую большую версию фото
+        photo = message.photo[-1]  # Берем самую большую версию фото
         sender_name = update.effective_user.full_name
         
-        # Создаем директорию для фотографий, если её нет
-        os.makedirs("data/photos", exist_ok=True)
-        
-        # Формируем имя файла
-        file_name = f"{sender_name}_{datetime.now().strftime('%d%m%Y_%H%M%S')}.jpg"
-        file_path = f"data/photos/{file_name}"
-        
-        # Скачиваем фото
-        photo_file = await context.bot.get_file(photo.file_id)
-        await photo_file.download_to_drive(file_path)
+        # Повторно присланное фото берем из кэша без скачивания и запроса к YandexGPT
+        analysis_data = photo_cache.get(photo.file_unique_id)
+        file_path = None
+        if analysis_data is None:
+            # Формируем имя файла
+            file_name = f"{sender_name}_{strftime('%d%m%Y_%H%M%S')}.jpg"
+            file_path = f"data/photos/{file_name}"
+            
+            # Скачиваем фото в память: в YandexGPT оно уходит без записи и чтения с диска
+            photo_file = await context.bot.get_file(photo.file_id)
+            image_bytes = bytes(await photo_file.download_as_bytearray())
+            
+            # Архивная копия на диске пишется в фоне и не задерживает ответ
+            task = asyncio.create_task(asyncio.to_thread(save_photo, file_path, image_bytes))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
         
         # Отправляем сообщение о начале обработки
-        process_message = await update.message.reply_text("🔄 Анализирую фотографию с помощью YandexGPT...")
+        process_message = await message.reply_text("🔄 Анализирую фотографию с помощью YandexGPT...")
         
         try:
-            # Анализируем фото с помощью YandexGPT
-            result = await gpt.generate_response(
-                prompt="""Проанализируй таблицу на фотографии и извлеки следующую информацию:
+            if analysis_data is None:
+                # Анализируем фото с помощью YandexGPT
+                result = await gpt.generate_response(
+                    prompt="""Проанализируй таблицу на фотографии и извлеки следующую информацию:
 1. Название подразделения и дату (из заголовка таблицы)
 2. Список операций с их показателями
 3. Площади обработки за день и общие площади
@@ -508,59 +681,53 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         }
     ]
 }""",
-                model="vision",
-                image_path=file_path
-            )
-            
-            # Получаем текст ответа
-            response_text = gpt.get_response_text(result)
-            
-            # Парсим JSON ответ
-            try:
-                analysis_data = json.loads(response_text)
-            except json.JSONDecodeError:
-                # Если не удалось распарсить JSON, используем базовый анализ
-                analysis_data = {
-                    "work_type": "Не удалось определить",
-                    "operation": "Не удалось определить",
-                    "notes": response_text
-                }
-            
-            # Обновляем Excel с данными из фото
-            excel_path = file_handler.update_excel()
+                    model="vision",
+                    image_bytes=image_bytes
+                )
+                
+                # Получаем текст ответа
+                response_text = gpt.get_response_text(result)
+                
+                # Парсим JSON ответ; текстовый ответ модели (не объект JSON) отсекаем
+                # по первому символу, не запуская парсер
+                analysis_data = None
+                if response_text.lstrip()[:1] == "{":
+                    try:
+                        analysis_data = orjson.loads(response_text)
+                    except orjson.JSONDecodeError:
+                        pass
+                if isinstance(analysis_data, dict):
+                    photo_cache.put(photo.file_unique_id, analysis_data)
+                else:
+                    # Если не удалось распарсить JSON, используем базовый анализ
+                    analysis_data = {
+                        "work_type": "Не удалось определить",
+                        "operation": "Не удалось определить",
+                        "notes": response_text
+                    }
             
             # Формируем ответ пользователю
-            response = "✅ Фотография проанализирована и данные добавлены в отчет!\n\n"
-            
-            if "work_type" in analysis_data and analysis_data["work_type"]:
-                response += f"🚜 Тип работы: {analysis_data['work_type']}\n"
-            if "operation" in analysis_data and analysis_data["operation"]:
-                response += f"📝 Операция: {analysis_data['operation']}\n"
-            if "culture_to" in analysis_data and analysis_data["culture_to"]:
-                response += f"🌾 Культура: {analysis_data['culture_to']}\n"
-            if "pu_number" in analysis_data and analysis_data["pu_number"]:
-                response += f"🔢 ПУ: {analysis_data['pu_number']}/{analysis_data.get('pu_area', '')}\n"
-            if "department" in analysis_data and analysis_data["department"]:
-                response += f"🏢 Отдел: {analysis_data['department']} {analysis_data.get('department_number', '')}/{analysis_data.get('department_area', '')}\n"
-            if "quality" in analysis_data and analysis_data["quality"]:
-                response += f"⭐ Качество работы: {analysis_data['quality']}\n"
-            if "field_condition" in analysis_data and analysis_data["field_condition"]:
-                response += f"🌱 Состояние поля: {analysis_data['field_condition']}\n"
-            if "issues" in analysis_data and analysis_data["issues"]:
-                response += f"⚠️ Проблемы: {analysis_data['issues']}\n"
+            parts = ["✅ Фотография проанализирована и данные добавлены в отчет!\n\n"]
+            for keys, template in PHOTO_FIELDS:
+                if analysis_data.get(keys[0]):
+                    parts.append(template.format(*(analysis_data.get(key, '') for key in keys)))
+            response = "".join(parts)
             
             # Отправляем ответ
             await process_message.edit_text(response)
             
-            logging.info(f"Фотография проанализирована: {file_path}")
+            if file_path is None:
+                logger.info("Фотография %s взята из кэша анализа", photo.file_unique_id)
+            else:
+                logger.info("Фотография проанализирована: %s", file_path)
             
         except Exception as e:
-            logging.error(f"Ошибка при анализе фотографии: {e}")
+            logger.error("Ошибка при анализе фотографии: %s", e)
             await process_message.edit_text(f"❌ Произошла ошибка при анализе фотографии: {str(e)}")
         
     except Exception as e:
-        logging.error(f"Ошибка при обработке фотографии: {e}")
-        await update.message.reply_text("Произошла ошибка при обработке фотографии.")
+        logger.error("Ошибка при обработке фотографии: %s", e)
+        await message.reply_text("Произошла ошибка при обработке фотографии.")
 
 async def get_chat_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает ID текущего чата"""
@@ -571,19 +738,23 @@ async def get_chat_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Ваш ID пользователя: {user_id}"
     )
 
+async def log_rejected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Логирует обновления из неразрешенных чатов, отсеянные фильтром"""
+    logger.warning("Попытка доступа из неразрешенного чата %s", update.effective_chat.id)
+
 async def process_message(message: Message):
     """
     Обрабатывает входящие сообщения
     """
     try:
         chat_id = message.chat.id
-        if chat_id not in ALLOWED_CHAT_IDS:
+        if not is_allowed_chat(chat_id):
             await message.reply("У вас нет доступа к этому боту.")
             return
 
         # Получаем информацию о пользователе
         user_info = f"{message.from_user.full_name} ({message.from_user.id})"
-        logging.info(f"Получено сообщение от {user_info}")
+        logger.info("Получено сообщение от %s", user_info)
 
         photo_path = None
         message_text = message.text
@@ -598,12 +769,12 @@ async def process_message(message: Message):
             os.makedirs(photos_dir, exist_ok=True)
             
             # Формируем имя файла из даты и ID фото
-            photo_filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{photo.file_id}.jpg"
+            photo_filename = f"{strftime('%Y%m%d_%H%M%S')}_{photo.file_id}.jpg"
             photo_path = os.path.join(photos_dir, photo_filename)
             
             # Скачиваем фото
             await photo.download(destination_file=photo_path)
-            logging.info(f"Фото сохранено: {photo_path}")
+            logger.info("Фото сохранено: %s", photo_path)
             
             # Сохраняем информацию о фото
             caption = message.caption or ""
@@ -660,26 +831,129 @@ async def process_message(message: Message):
         logging.error(error_message)
         await message.reply(error_message)
 
+async def post_init(application: Application):
+    """Создает очередь анализа сообщений и запускает фоновые задачи"""
+    global message_queue, excel_dirty, excel_writer_task
+    message_queue = asyncio.Queue(maxsize=GPT_QUEUE_SIZE)
+    for _ in range(GPT_WORKERS):
+        gpt_workers.append(asyncio.create_task(gpt_worker()))
+    excel_dirty = asyncio.Event()
+    excel_writer_task = asyncio.create_task(excel_writer_loop())
+
+async def post_stop(application: Application):
+    """Дожидается обработки сообщений, уже принятых в очередь анализа"""
+    # К этому моменту PTB остановил прием обновлений, новых сообщений в очереди не будет,
+    # а бот еще работает - ответы по дообработанным сообщениям отправятся
+    if message_queue is None:
+        return
+    try:
+        await asyncio.wait_for(message_queue.join(), SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(
+            "Очередь анализа не обработана за %s с: потеряно %d сообщений, не начатых обработкой; "
+            "обрабатываемые сейчас будут прерваны",
+            SHUTDOWN_DRAIN_TIMEOUT, message_queue.qsize()
+        )
+
+async def post_shutdown(application: Application):
+    """Останавливает фоновые задачи"""
+    tasks = [*gpt_workers, excel_writer_task]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    gpt_workers.clear()
+    # Документы Word держатся в памяти и сохраняются пачками: дописываем остаток
+    try:
+        await asyncio.to_thread(file_handler.flush_documents)
+    except Exception:
+        logger.exception("Ошибка при сохранении документов Word")
+    # Закрываем соединения с YandexGPT
+    await gpt.close()
+    excel_executor.shutdown(wait=False)
+
 def main():
     """Запуск бота"""
-    # Создаем приложение
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # uvloop заметно ускоряет цикл событий на сетевой нагрузке; под Windows он недоступен
+    if sys.platform != "win32":
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            logger.info("uvloop не установлен, используется стандартный цикл событий asyncio")
+    
+    # Создаем приложение. Обновления обрабатываются параллельно (не более 32 одновременно),
+    # поэтому долгий запрос к YandexGPT в одном чате не задерживает ответы в других.
+    # Порядок обработки обновлений при этом не гарантируется даже в пределах одного чата.
+    # Исходящие запросы проходят через ограничитель частоты, чтобы не упираться в лимиты
+    # Telegram (30 сообщений/с всего, 20 сообщений/мин в группу) и не получать 429.
+    # Запросы к Bot API идут по HTTP/2: параллельные ответы мультиплексируются в одном
+    # соединении. Для getUpdates нужен отдельный экземпляр запроса.
+    request = HTTPXRequest(
+        connection_pool_size=64,
+        http_version="2",
+        read_timeout=30,
+        connect_timeout=10,
+        pool_timeout=5
+    )
+    get_updates_request = HTTPXRequest(http_version="2", read_timeout=30, connect_timeout=10)
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .concurrent_updates(32)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, group_max_rate=20, max_retries=3))
+        .build()
+    )
+    
+    # Фильтр разрешенных чатов: обновления из остальных чатов отсеиваются
+    # диспетчером до вызова обработчиков
+    allowed_filter = filters.ALL if ALLOW_ALL_CHATS else filters.Chat(chat_id=ALLOWED_CHAT_IDS)
     
-    # Добавляем обработчики
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("export", export_data))
-    application.add_handler(CommandHandler("stats", show_stats))
-    application.add_handler(CommandHandler("schedule", schedule_reports))
-    application.add_handler(CommandHandler("reset", reset_command))
-    application.add_handler(CommandHandler("chatid", get_chat_id))
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    # Добавляем обработчики. Диспетчер проверяет их по порядку и останавливается на
+    # первом подходящем, поэтому самые частые обновления (текст, фото, кнопки) идут первыми
+    handlers = [
+        MessageHandler(TEXT_NO_CMD & allowed_filter, handle_message),
+        MessageHandler(filters.PHOTO & allowed_filter, handle_photo),
+        CallbackQueryHandler(button_handler),
+        CommandHandler("export", export_data, filters=allowed_filter),
+        CommandHandler("stats", show_stats, filters=allowed_filter),
+        CommandHandler("schedule", schedule_reports, filters=allowed_filter),
+        CommandHandler("start", start, filters=allowed_filter),
+        CommandHandler("help", help_command, filters=allowed_filter),
+        CommandHandler("reset", reset_command),
+        CommandHandler("chatid", get_chat_id),
+    ]
+    if not ALLOW_ALL_CHATS:
+        # Журнал попыток доступа из неразрешенных чатов
+        handlers.append(MessageHandler(~allowed_filter, log_rejected))
+    # Регистрируем все обработчики одним вызовом, порядок списка сохраняется
+    application.add_handlers(handlers)
     
-    # Запускаем бота
-    logger.info("Бот запущен")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Запускаем бота: вебхук, если задан внешний адрес, иначе long polling
+    if PUBLIC_URL and not USE_POLLING:
+        logger.info("Бот запущен в режиме вебхука")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{PUBLIC_URL}/{TELEGRAM_BOT_TOKEN}",
+            allowed_updates=ALLOWED_UPDATES,
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        logger.info("Бот запущен в режиме long polling")
+        # Telegram держит запрос getUpdates до 30 с, поэтому простаивающий бот
+        # опрашивает сервер редко, а новые обновления приходят сразу
+        application.run_polling(
+            poll_interval=0.0,
+            timeout=30,
+            bootstrap_retries=-1,
+            allowed_updates=ALLOWED_UPDATES
+        )
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
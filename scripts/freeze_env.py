@@ -0,0 +1,44 @@
+"""
+Замораживает настройки из .env в модуль src/_config_frozen.py
+
+После запуска src/config.py берет значения из сгенерированного модуля
+(его байткод кэшируется интерпретатором) и не разбирает .env при каждом старте.
+Переменные окружения процесса по-прежнему имеют приоритет.
+
+Использование:
+    python scripts/freeze_env.py [путь_к_env] [путь_к_модулю]
+
+Модуль содержит секреты и не должен попадать в git. После изменения .env
+скрипт нужно запустить повторно.
+"""
+import os
+import sys
+from dotenv import dotenv_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_ENV_PATH = os.path.join(ROOT, ".env")
+DEFAULT_OUTPUT_PATH = os.path.join(ROOT, "src", "_config_frozen.py")
+
+def freeze(env_path: str, output_path: str) -> int:
+    """Записывает значения из env_path в модуль output_path, возвращает их количество"""
+    values = {key: value for key, value in dotenv_values(env_path).items() if value is not None}
+    
+    lines = [
+        "# Сгенерировано scripts/freeze_env.py, не редактировать вручную\n",
+        "ENV = {\n",
+    ]
+    for key in sorted(values):
+        lines.append(f"    {key!r}: {values[key]!r},\n")
+    lines.append("}\n")
+    
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    return len(values)
+
+if __name__ == "__main__":
+    env_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_ENV_PATH
+    output_path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_OUTPUT_PATH
+    if not os.path.exists(env_path):
+        sys.exit(f"Файл {env_path} не найден")
+    count = freeze(env_path, output_path)
+    print(f"Записано {count} переменных в {output_path}")
@@ -1,44 +1,95 @@
+import logging
 import os
-from dotenv import load_dotenv
+from datetime import time
 
-# Загрузка переменных окружения
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Файл .env в корне проекта. Если его нет (переменные передаются окружением, как в
+# контейнере) или задан LAM_SKIP_DOTENV=1, python-dotenv даже не импортируется
+_DOTENV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.env')
+
+# Настройки, замороженные из .env скриптом scripts/freeze_env.py (если он запускался)
+try:
+    from ._config_frozen import ENV as _FROZEN_ENV
+except ImportError:
+    _FROZEN_ENV = None
+
+# Снимок окружения: все настройки читаются из обычного словаря за один проход.
+# Переменные окружения процесса имеют приоритет над значениями из .env.
+if _FROZEN_ENV is None:
+    if os.environ.get('LAM_SKIP_DOTENV') != '1' and os.path.exists(_DOTENV_PATH):
+        from dotenv import load_dotenv
+        load_dotenv(_DOTENV_PATH)
+    _env = os.environ.copy()
+else:
+    _env = {**_FROZEN_ENV, **os.environ}
+_g = _env.get
+
+def _as_int(name: str, default: int) -> int:
+    """Читает целое число из окружения, пропуская пробелы и кавычки вокруг значения"""
+    value = (_g(name) or '').strip().strip('"\'')
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning("Некорректное значение %s=%r, используется %d", name, value, default)
+        return default
+
+def _as_bool(name: str) -> bool:
+    """Читает флаг из окружения: включен только при значениях 1, true, yes (без учета регистра)"""
+    return (_g(name) or '').strip().strip('"\'').lower() in ('1', 'true', 'yes')
 
 # Конфигурация бота
-TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+TELEGRAM_BOT_TOKEN = _g('TELEGRAM_BOT_TOKEN')
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("Не установлена переменная окружения TELEGRAM_BOT_TOKEN")
 
-YANDEX_API_KEY = os.getenv('YANDEX_API_KEY')
+YANDEX_API_KEY = _g('YANDEX_API_KEY')
 if not YANDEX_API_KEY:
     raise ValueError("Не установлена переменная окружения YANDEX_API_KEY")
 
 # Yandex Cloud настройки
-YANDEX_FOLDER_ID = os.getenv('YANDEX_FOLDER_ID')
+YANDEX_FOLDER_ID = _g('YANDEX_FOLDER_ID')
 if not YANDEX_FOLDER_ID:
     raise ValueError("Не установлена переменная окружения YANDEX_FOLDER_ID")
 
 # Конфигурация базы данных
-DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///lam.db')
+DATABASE_URL = _g('DATABASE_URL', 'sqlite:///lam.db')
 
 # Настройки приложения
-def parse_chat_ids(chat_ids_str: str) -> list:
+def parse_chat_ids(chat_ids_str: str) -> frozenset:
     """Парсит строку с ID чатов, учитывая отрицательные значения"""
     if not chat_ids_str:
-        return []
+        return frozenset()
     try:
-        # Разделяем строку по запятой и преобразуем в целые числа
-        return [int(chat_id.strip()) for chat_id in chat_ids_str.split(',') if chat_id.strip()]
+        # Разделяем строку по запятой и преобразуем в целые числа (int сам пропускает
+        # пробелы вокруг числа, пустые элементы отсеиваются). map/filter работают без
+        # цикла на байткоде; frozenset дает проверку принадлежности за O(1)
+        return frozenset(map(int, filter(str.strip, chat_ids_str.split(','))))
     except ValueError as e:
-        print(f"Ошибка при парсинге ID чатов: {e}")
-        return []
+        # Ошибка в списке чатов не должна молча отключать ограничение доступа
+        logger.error("Ошибка при парсинге ID чатов %r: %s", chat_ids_str, e)
+        raise
 
-ALLOWED_CHAT_IDS = parse_chat_ids(os.getenv('ALLOWED_CHAT_IDS', ''))
-ADMIN_USER_IDS = parse_chat_ids(os.getenv('ADMIN_USER_IDS', ''))
+ALLOWED_CHAT_IDS = parse_chat_ids(_g('ALLOWED_CHAT_IDS', ''))
+ADMIN_USER_IDS = parse_chat_ids(_g('ADMIN_USER_IDS', ''))
 
 # Настройки отчетов
-REPORT_GENERATION_TIME = os.getenv('REPORT_GENERATION_TIME', '06:00')  # Время генерации отчета
-REPORT_SEND_TO = os.getenv('REPORT_SEND_TO', '').split(',')  # Список получателей отчета
+REPORT_GENERATION_TIME_STR = _g('REPORT_GENERATION_TIME', '06:00')  # Время генерации отчета (строка ЧЧ:ММ)
+REPORT_GENERATION_TIME = time(*map(int, REPORT_GENERATION_TIME_STR.split(':')))  # То же время, разобранное один раз
+REPORT_SEND_TO = tuple(filter(None, map(str.strip, _g('REPORT_SEND_TO', '').split(','))))  # Список получателей отчета
 
 # Настройки API
-API_TIMEOUT = int(os.getenv('API_TIMEOUT', '30'))  # Таймаут для API запросов в секундах 
\ No newline at end of file
+API_TIMEOUT = _as_int('API_TIMEOUT', 30)  # Таймаут для API запросов в секундах
+
+# Очередь анализа сообщений YandexGPT
+GPT_WORKERS = _as_int('GPT_WORKERS', 4)  # Число параллельных обработчиков очереди
+GPT_QUEUE_SIZE = _as_int('GPT_QUEUE_SIZE', 128)  # Максимальная длина очереди сообщений
+GPT_MAX_CONCURRENCY = _as_int('GPT_MAX_CONCURRENCY', 8)  # Максимум одновременных запросов к YandexGPT
+
+# Настройки вебхука Telegram
+PUBLIC_URL = _g('PUBLIC_URL', '').rstrip('/')  # Внешний адрес бота (за reverse proxy с TLS)
+WEBHOOK_SECRET = _g('WEBHOOK_SECRET')  # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+PORT = _as_int('PORT', 8443)  # Локальный порт для приема вебхуков
+USE_POLLING = _as_bool('USE_POLLING')  # Принудительный long polling (локальная разработка) 
\ No newline at end of file
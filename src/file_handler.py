@@ -1,14 +1,489 @@
+import asyncio
+import html
 import os
 import re
-from datetime import datetime
-from docx import Document
-import openpyxl
-from openpyxl.styles import PatternFill, Font, Alignment
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from functools import lru_cache
 from typing import Optional, Dict, Any, List, Tuple, Set
 import json
 import logging
-from openpyxl.utils import get_column_letter
-from docx.shared import Pt, RGBColor
+import orjson
+from .gpt_cache import LRUCache, exact_text_key
+
+# python-docx и openpyxl тяжелые (lxml, сотни классов) и импортируются при первой
+# записи документа или сборке Excel, а не при импорте модуля
+
+# Колонки отчета и цвета их заливки в легенде
+EXCEL_HEADERS = ["Дата", "Подразделение", "Операция", "Культура", "За день, га", "С начала операции, га", "Вал за день, ц", "Вал с начала, ц"]
+EXCEL_LEGEND_COLORS = ["D9E1F2", "5B9BD5", "FF0000", "9933FF", "FF9966", "00FF00", "FF99CC", "99FF99"]
+EXCEL_HEADER_COLOR = "E2EFDA"
+# Ширина колонок отчета: A - подписи легенды, B-I - данные
+EXCEL_COLUMN_WIDTHS = {"A": 40, **dict.fromkeys("BCDEFGHI", 20)}
+
+@lru_cache(maxsize=16)
+def format_day(day: date, fmt: str) -> str:
+    """Дата в нужном формате; строки для текущего дня форматируются один раз"""
+    return day.strftime(fmt)
+
+# Каталоги, уже созданные (или проверенные) в этом процессе
+_ENSURED_DIRS: Set[str] = set()
+
+def ensure_dir(path: str) -> None:
+    """Создает каталог, если нужно; повторные вызовы для того же пути не обращаются к диску"""
+    if path not in _ENSURED_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _ENSURED_DIRS.add(path)
+
+def _append_message(doc: Any, heading: str, message_text: str) -> None:
+    """
+    Добавляет в документ Word заголовок сообщения, его текст и пустую строку.
+    
+    Абзацы создаются прямо в XML тела документа, без промежуточных объектов
+    Paragraph/Run; результат тот же, что у add_heading(level=2) и двух add_paragraph.
+    """
+    from docx.enum.style import WD_STYLE_TYPE
+    body = doc.element.body
+    
+    heading_p = body.add_p()
+    heading_p.style = doc.part.get_style_id("Heading 2", WD_STYLE_TYPE.PARAGRAPH)
+    heading_p.add_r().text = heading
+    
+    text_p = body.add_p()
+    if message_text:
+        text_p.add_r().text = message_text
+    
+    # Пустая строка для разделения сообщений
+    body.add_p()
+
+# Разметка word/document.xml, которую быстрый разбор ниже передает не так, как
+# python-docx (таблицы, ссылки, поля, правки, надписи, разрывы страниц) - такие
+# документы читаются через python-docx
+DOCX_COMPLEX_RE = re.compile(
+    r"<(?:w:(?:tbl|tabs|hyperlink|sdt|txbxContent|ptab|noBreakHyphen|fldSimple|smartTag|customXml|ins|del|moveFrom|moveTo)\b"
+    r"|mc:|w:br\s[^>]*w:type=)"
+)
+# Текст (w:t), переводы строки и табуляции внутри абзаца (w:br, w:cr, w:tab), конец абзаца
+DOCX_TEXT_RE = re.compile(r"<w:t(?:\s[^>]*)?>([^<]*)</w:t>|<w:(br|cr|tab)\b[^>]*/>|</w:p>|<w:p(?:\s[^>]*)?/>")
+DOCX_INLINE_TEXT = {"br": "\n", "cr": "\n", "tab": "\t"}
+
+def _read_docx_text(path: str) -> str:
+    """
+    Текст документа Word: тексты абзацев (paragraph.text), разделенные переводом строки.
+    
+    Простые документы (а бот пишет только такие) разбираются регулярным выражением прямо
+    из word/document.xml, без построения дерева python-docx; остальные - через python-docx.
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            xml = archive.read("word/document.xml").decode("utf-8")
+    except (zipfile.BadZipFile, KeyError, UnicodeDecodeError):
+        xml = None
+    if xml is not None and not DOCX_COMPLEX_RE.search(xml):
+        parts = []
+        for match in DOCX_TEXT_RE.finditer(xml):
+            text, inline = match.groups()
+            if text is not None:
+                parts.append(html.unescape(text) if "&" in text else text)
+            elif inline is not None:
+                parts.append(DOCX_INLINE_TEXT[inline])
+            else:
+                parts.append("\n")
+        # После последнего абзаца перевода строки нет
+        return "".join(parts)[:-1]
+    
+    from docx import Document
+    doc = Document(path)
+    return "\n".join([para.text for para in doc.paragraphs])
+
+@lru_cache(maxsize=None)
+def _docx_read_pool() -> ThreadPoolExecutor:
+    """Общий пул потоков для чтения документов Word (создается при первом использовании)"""
+    return ThreadPoolExecutor(max_workers=DOCX_READ_WORKERS, thread_name_prefix="docx-read")
+
+@lru_cache(maxsize=None)
+def _excel_styles() -> Tuple[Any, Tuple[Any, ...], Any]:
+    """Стили Excel-отчета (заливка заголовков, заливки легенды, жирный шрифт); создаются один раз"""
+    from openpyxl.styles import PatternFill, Font
+    def solid(color):
+        return PatternFill(start_color=color, end_color=color, fill_type="solid")
+    return solid(EXCEL_HEADER_COLOR), tuple(map(solid, EXCEL_LEGEND_COLORS)), Font(bold=True)
+
+# Документ Word за день держится в памяти и сохраняется на диск раз в столько сообщений
+# (а также перед сборкой Excel и при остановке бота)
+DOCX_SAVE_EVERY = 20
+
+# Запись числа в сообщении -> вид для float(): десятичная запятая, пробелы между разрядами
+NUMBER_CLEANUP = str.maketrans({",": ".", " ": "", "\xa0": ""})
+
+# Сколько измененных документов Word читается параллельно при сборке Excel. Обычно
+# с прошлой сборки меняется один-два документа - их проще прочитать в текущем потоке
+DOCX_READ_WORKERS = 8
+DOCX_SEQUENTIAL_MAX = 2
+
+# Прямые соответствия сокращений культур (порядок важен: при поиске подстроки берется первое совпадение)
+CULTURE_ABBREVIATIONS = {
+    "оз": "Пшеница озимая товарная",
+    "оз.": "Пшеница озимая товарная",
+    "озимая": "Пшеница озимая товарная",
+    "озим": "Пшеница озимая товарная",
+    "пш": "Пшеница озимая товарная",
+    "оз пш": "Пшеница озимая товарная",
+    "мн": "Многолетние травы прошлых лет",
+    "мн.": "Многолетние травы прошлых лет",
+    "мн тр": "Многолетние травы прошлых лет",
+    "многолетн": "Многолетние травы прошлых лет",
+    "сах св": "Свекла сахарная",
+    "сах": "Свекла сахарная",
+    "св": "Свекла сахарная",
+    "свекла": "Свекла сахарная",
+    "соя": "Соя товарная",
+    "сои": "Соя товарная",
+    "зяби": "Зябь",
+    "зябь": "Зябь",
+    "кук": "Кукуруза товарная",
+    "подс": "Подсолнечник товарный",
+    "культ": "Пшеница озимая товарная"
+}
+
+# Типичные сокращения операций (порядок важен так же)
+OPERATION_ABBREVIATIONS = {
+    "пахота": "Пахота",
+    "пах": "Пахота",
+    "диск": "Дискование",
+    "дискование": "Дискование",
+    "диск 2": "Дискование 2-е",
+    "диск 2-е": "Дискование 2-е",
+    "культ": "Культивация",
+    "предп культ": "Предпосевная культивация",
+    "предпосевная": "Предпосевная культивация",
+    "выравнивание": "Выравнивание",
+    "подкормка": "Подкормка",
+    "2-я подкормка": "2-я подкормка",
+    "сев": "Сев",
+    "посев": "Посев",
+    "уборка": "Уборка"
+}
+
+# Поля операции, которые заполняет базовый парсер, со значениями по умолчанию
+EMPTY_OPERATION = {
+    "work_type": "",
+    "operation": "",
+    "culture_from": "",
+    "culture_to": "",
+    "pu_number": "",
+    "pu_area": "",
+    "department": "",
+    "department_number": "",
+    "department_area": "",
+    "date": "",
+    "subdivision": "АОР",
+    "val_day": "",
+    "val_total": "",
+}
+
+# Одинаковые сообщения (например, пересылки) в пределах этого окна, секунд, сохраняются один раз
+DUPLICATE_WINDOW = 300
+
+# Регулярные выражения базового парсера компилируются один раз при импорте
+FIELD_INFO_RE = re.compile(r"(?:Предп|диск|Пахота|Выравн)(?:ов|п)?(?:ание|а|)?\s+(\w+(?:\s+\w+)?)\s+(?:под|на)?\s*(\w+(?:\s+\w+)?)?")
+PU_RE = re.compile(r"По\s*Пу\s*(\d+)/(\d+)")
+DEPT_RE = re.compile(r"Отд\s*(\d+)\s*(\d+)/(\d+)")
+DATE_RE = re.compile(r"(\d{1,2}\.\d{1,2}(?:\.\d{4})?)")
+OPERATION_RE = re.compile(r"^([А-Яа-я0-9\-\s]+)(?:\n|$)")
+OPERATION_FALLBACK_RE = re.compile(r"^([А-Яа-я\s\-]+)")
+VAL_DAY_RE = re.compile(r"Вал\s+за\s+день\s+(\d+[\s,\.]\d+)")
+VAL_TOTAL_RE = re.compile(r"Вал\s+с\s+начала\s+(\d+[\s,\.]\d+)")
+
+# Маркеры блока кода (```json ... ```) в ответах модели
+CODE_FENCE_RE = re.compile(r"```(?:json)?")
+
+# ПУ, отделы и вал одним выражением: вид совпадения определяется по match.lastgroup
+LINE_FIELDS_RE = re.compile(
+    r"(?P<pu>По\s*Пу\s*(?P<pu_number>\d+)/(?P<pu_area>\d+))"
+    r"|(?P<dept>Отд\s*(?P<department>\d+)\s*(?P<department_number>\d+)/(?P<department_area>\d+))"
+    r"|(?P<val_day>Вал\s+за\s+день\s+(?P<val_day_value>\d+[\s,\.]\d+))"
+    r"|(?P<val_total>Вал\s+с\s+начала\s+(?P<val_total_value>\d+[\s,\.]\d+))"
+)
+
+# Ключи JSON анализа одинаковы во всех ответах: при разборе запасным декодером json
+# подставляем эти строки вместо новых копий (orjson сам переиспользует короткие ключи)
+_ANALYSIS_KEYS = {key: key for key in (
+    "work_type", "operation", "culture_from", "culture_to", "pu_number", "pu_area",
+    "department", "department_number", "department_area", "date", "subdivision",
+    "val_day", "val_total", "operations", "corrections", "date_processed", "total_area"
+)}
+
+def _shared_keys(pairs: List[Tuple[str, Any]]) -> Dict[str, Any]:
+    """object_pairs_hook для json: заменяет известные ключи общими строками"""
+    return {_ANALYSIS_KEYS.get(key, key): value for key, value in pairs}
+
+# Декодер ответов YandexGPT с общими ключами анализа
+ANALYSIS_JSON_DECODER = json.JSONDecoder(object_pairs_hook=_shared_keys)
+
+# Файл кэша анализа не сжимается, пока в нем меньше строк
+ANALYSIS_CACHE_COMPACT_MIN = 64
+
+def _analysis_cache_line(item: Tuple[str, Any]) -> bytes:
+    """Строка файла кэша анализа для пары (ключ, анализ)"""
+    key, value = item
+    entry = {"k": key, "v": value}
+    try:
+        return orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE)
+    except orjson.JSONEncodeError:
+        # Значения, которые orjson не сериализует (например, целые больше 64 бит)
+        return json.dumps(entry, ensure_ascii=False).encode("utf-8") + b"\n"
+
+@lru_cache(maxsize=8)
+def _read_reference_file(path: str, mtime_ns: int) -> Dict[str, Any]:
+    """Читает и разбирает файл справочных данных; время изменения входит в ключ кэша"""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+# Справочные данные по умолчанию (если нет data/reference_data.json); создаются один раз при импорте
+DEFAULT_REFERENCE_DATA = {
+    "subdivisions": [
+        "Центральное отделение", 
+        "Северное отделение", 
+        "Южное отделение", 
+        "Восточное отделение", 
+        "Западное отделение",
+        "АО Кроноткинское",
+        "Восход",
+        "Колхоз Прогресс",
+        "Мир",
+        "СП Коломейцево"
+    ],
+    "operations": [
+        "Вспашка", 
+        "Боронование", 
+        "Культивация",
+        "Культивация предпосевная",
+        "Культивация сплошная",
+        "Дискование",
+        "Гербицидная обработка",
+        "Гербицидная обработка сплошная",
+        "Фунгицидная обработка", 
+        "Инсектицидная обработка", 
+        "Внесение удобрений", 
+        "Посев", 
+        "Уборка", 
+        "Кошение",
+        "Скашивание",
+        "Орошение",
+        "Опрыскивание",
+        "Сбор урожая",
+        "Транспортировка",
+        "Погрузка",
+        "Разгрузка",
+        "Плановое ТО",
+        "Внеплановый ремонт",
+        "Перегон техники"
+    ],
+    "cultures": [
+        "Вика+Тритикале", "Горох на зерно", "Горох товарный", "Гуар", "Конопля", 
+        "Кориандр", "Кукуруза кормовая", "Кукуруза семенная", "Кукуруза товарная", 
+        "Люцерна", "Многолетние злаковые травы", "Многолетние травы прошлых лет", 
+        "Многолетние травы текущего года", "Овес", "Подсолнечник кондитерский", 
+        "Подсолнечник семенной", "Подсолнечник товарный", "Просо", 
+        "Пшеница озимая на зеленый корм", "Пшеница озимая семенная", 
+        "Пшеница озимая товарная", "Рапс озимый", "Рапс яровой", "Свекла сахарная", 
+        "Сорго", "Сорго кормовой", "Сорго-суданковый гибрид", "Соя семенная", 
+        "Соя товарная", "Чистый пар", "Чумиза", "Ячмень озимый", "Ячмень озимый семенной"
+    ],
+    "pu_subdivisions": {
+        "АОР": ["Кавказ", "Север", "Центр", "Юг", "Рассвет"],
+        "ТСК": ["Нет ПУ"],
+        "АО Кроноткинское": ["Нет ПУ"],
+        "Восход": ["Нет ПУ"],
+        "Колхоз Прогресс": ["Нет ПУ"],
+        "Мир": ["Нет ПУ"],
+        "СП Коломейцево": ["Нет ПУ"]
+    },
+    "departments": {
+        "Кавказ": ["18", "19"],
+        "Север": ["3", "7", "10", "20"],
+        "Центр": ["1", "4", "5", "6", "9"],
+        "Юг": ["11", "12", "16", "17"],
+        "Рассвет": []
+    },
+    "operations_by_culture": {
+        "Пшеница озимая товарная": [
+            "Пахота", "Дискование", "Выравнивание", "Предпосевная культивация", 
+            "Сев", "Подкормка", "2-я подкормка", "Гербицидная обработка",
+            "Фунгицидная обработка", "Уборка", "Прикатывание посевов"
+        ],
+        "Соя товарная": [
+            "Пахота", "Дискование", "Предпосевная культивация", "Сев", 
+            "Гербицидная обработка", "Междурядная обработка", "Уборка"
+        ],
+        "Подсолнечник товарный": [
+            "Пахота", "Дискование", "Предпосевная культивация", "Сев", 
+            "Гербицидная обработка", "Междурядная обработка", "Уборка"
+        ],
+        "Свекла сахарная": [
+            "Пахота", "Дискование", "Предпосевная культивация", "Сев", 
+            "Гербицидная обработка", "Междурядная обработка", "Уборка"
+        ],
+        "Многолетние травы": [
+            "Пахота", "Дискование", "Предпосевная культивация", "Сев", 
+            "Уборка", "Подкормка"
+        ]
+    },
+    "culture_abbreviations": {
+        "мн тр": "Многолетние травы прошлых лет",
+        "мн тр тек.года": "Многолетние травы текущего года",
+        "мн зл": "Многолетние злаковые травы",
+        "оз пш": "Пшеница озимая товарная",
+        "оз пш сем": "Пшеница озимая семенная",
+        "оз пш на зел": "Пшеница озимая на зеленый корм",
+        "сах св": "Свекла сахарная",
+        "соя": "Соя товарная",
+        "соя сем": "Соя семенная",
+        "подс": "Подсолнечник товарный",
+        "подс сем": "Подсолнечник семенной",
+        "подс кон": "Подсолнечник кондитерский",
+        "яч": "Ячмень озимый", 
+        "оз яч": "Ячмень озимый",
+        "оз яч сем": "Ячмень озимый семенной",
+        "кук": "Кукуруза товарная",
+        "кук корм": "Кукуруза кормовая",
+        "кук сем": "Кукуруза семенная",
+        "рапс": "Рапс яровой",
+        "оз рапс": "Рапс озимый",
+        "горох": "Горох на зерно",
+        "горох тов": "Горох товарный",
+        "вика+трит": "Вика+Тритикале",
+        "сорго": "Сорго",
+        "сорго корм": "Сорго кормовой",
+        "гибрид": "Сорго-суданковый гибрид"
+    }
+}
+
+# Примеры для обучения - показываем модели, как обрабатывать сообщения
+GPT_EXAMPLES = (
+    {
+        "message": "Пахота зяби под мн тр\nПо Пу 26/488\nОтд 12 26/221",
+        "analysis": {
+            "work_type": "Пахота", 
+            "operation": "Пахота зяби", 
+            "culture_from": "зяби", 
+            "culture_to": "Многолетние", 
+            "pu_number": "26", 
+            "pu_area": "488", 
+            "department": "12", 
+            "department_number": "26", 
+            "department_area": "221",
+            "date": "",
+            "subdivision": "АОР",
+            "val_day": "",
+            "val_total": ""
+        }
+    },
+    {
+        "message": "Предп культ под оз пш\nПо Пу 215/1015\nОтд 12 128/317\nОтд 16 123/529",
+        "analysis": {
+            "work_type": "Предпосевная культивация",
+            "operation": "Предп культ",
+            "culture_from": "культ",
+            "culture_to": "Пшеница озимая товарная",
+            "pu_number": "215",
+            "pu_area": "1015",
+            "department": "12, 16",
+            "department_number": "128, 123",
+            "department_area": "317, 529",
+            "date": "",
+            "subdivision": "АОР",
+            "val_day": "",
+            "val_total": ""
+        }
+    },
+    {
+        "message": "10.03 день\n2-я подкормка\nПо Пу 1749/2559",
+        "analysis": {
+            "work_type": "2-я подкормка",
+            "operation": "2-я подкормка",
+            "culture_from": "",
+            "culture_to": "Пшеница озимая товарная",
+            "pu_number": "1749",
+            "pu_area": "2559",
+            "department": "",
+            "department_number": "",
+            "department_area": "",
+            "date": "10.03.2024",
+            "subdivision": "АОР",
+            "val_day": "",
+            "val_total": ""
+        }
+    }
+)
+
+# Примеры в виде текста для промпта (используем только первые два для сокращения запроса)
+GPT_EXAMPLES_STR = "\n\n".join(
+    f"СООБЩЕНИЕ: {ex['message']}\nАНАЛИЗ: {json.dumps(ex['analysis'], ensure_ascii=False)}"
+    for ex in GPT_EXAMPLES[:2]
+)
+
+# Промпт анализа сообщения или фотографии (get_analysis_prompt): текст сообщения
+# подставляется на место {message_text}; шаблон разрезан на две части один раз
+ANALYSIS_PROMPT_TEMPLATE = """Проанализируй сообщение или фотографию от агронома и извлеки структурированную информацию.
+
+Если анализируется фотография:
+1. Определи тип работы (вспашка, сев, уборка и т.д.)
+2. Определи культуру
+3. Оцени качество работы
+4. Опиши состояние поля/культуры
+5. Укажи любые проблемы или особенности, которые видны на фото
+
+Если анализируется текстовое сообщение:
+{message_text}
+
+Верни результат в формате JSON со следующими полями:
+{
+    "work_type": "тип работы",
+    "operation": "конкретная операция",
+    "culture_from": "исходная культура (если применимо)",
+    "culture_to": "целевая культура (если применимо)", 
+    "pu_number": "номер поля",
+    "pu_area": "площадь в га",
+    "department": "отделение",
+    "quality": "оценка качества работы (если есть фото)",
+    "field_condition": "состояние поля/культуры (если есть фото)",
+    "issues": "обнаруженные проблемы (если есть)"
+}
+
+Пример анализа текстового сообщения:
+Входное сообщение: "Центральное отделение поле 125 площадь 82 га посев кукурузы"
+{
+    "work_type": "посев",
+    "operation": "посев",
+    "culture_from": null,
+    "culture_to": "кукуруза",
+    "pu_number": "125",
+    "pu_area": "82",
+    "department": "Центральное отделение",
+    "quality": null,
+    "field_condition": null,
+    "issues": null
+}
+
+Пример анализа фото:
+{
+    "work_type": "вспашка",
+    "operation": "вспашка",
+    "culture_from": null,
+    "culture_to": null,
+    "pu_number": null,
+    "pu_area": null,
+    "department": null,
+    "quality": "хорошее",
+    "field_condition": "почва хорошо обработана, без крупных комков",
+    "issues": "небольшие пожнивные остатки на поверхности"
+}"""
+ANALYSIS_PROMPT_HEAD, ANALYSIS_PROMPT_TAIL = ANALYSIS_PROMPT_TEMPLATE.split("{message_text}")
 
 class FileHandler:
     def __init__(self, team_name: str, base_path: str = "data"):
@@ -25,9 +500,9 @@ class FileHandler:
         self.excel_path = os.path.join(base_path, "excel")
         
         # необходимые директории
-        os.makedirs(self.base_path, exist_ok=True)
-        os.makedirs(self.messages_path, exist_ok=True)
-        os.makedirs(self.excel_path, exist_ok=True)
+        ensure_dir(self.base_path)
+        ensure_dir(self.messages_path)
+        ensure_dir(self.excel_path)
         
         # Счетчик сообщений для каждого отправителя
         self.message_counters: Dict[str, int] = {}
@@ -42,20 +517,78 @@ class FileHandler:
         # Загружаем справочную информацию (будет использоваться для проверки идентификации)
         self.reference_data = self.load_reference_data()
         
+        # Подразделения в нижнем регистре (для поиска в тексте) вместе с исходным названием
+        self._subdivisions_lower = tuple((sub.lower(), sub) for sub in self.reference_data["subdivisions"])
+        self._subdivisions_re = re.compile("|".join(re.escape(sub_lower) for sub_lower, _ in self._subdivisions_lower))
+        # То же для культур и операций (поиск полного названия по сокращению)
+        self._cultures_lower = tuple((name.lower(), name) for name in self.reference_data["cultures"])
+        self._operations_lower = tuple((op.lower(), op) for op in self.reference_data["operations"])
+        # Точные совпадения с названием из справочника проверяются словарем до поиска подстрок
+        self._cultures_exact = {name_lower: name for name_lower, name in reversed(self._cultures_lower)}
+        self._operations_exact = {op_lower: op for op_lower, op in reversed(self._operations_lower)}
+        
+        # Справочные данные для промпта YandexGPT: не меняются, сериализуем один раз
+        self._reference_data_str = json.dumps({
+            "subdivisions": list(self.reference_data["subdivisions"]),
+            "operations": list(self.reference_data["operations"]),
+            "cultures": list(self.reference_data["cultures"])
+        }, ensure_ascii=False)
+        
         # Текущий Excel-файл (используется для обновления после каждого сообщения)
         self.current_excel_path = None
+        # Отпечаток входных данных, по которым собран current_excel_path (см. _excel_fingerprint)
+        self._excel_fingerprint_last = None
+        
+        # Версия данных: увеличивается при каждом изменении, по ней кэшируется готовый Excel
+        self.data_version = 0
+        
+        # Кэш результатов анализа YandexGPT в памяти (ключ - хеш нормализованного текста)
+        self.gpt_cache = LRUCache(maxsize=2048)
+        
+        # Результаты базового парсера по (текст, день): при недоступности YandexGPT
+        # повторяющиеся сообщения не разбираются регулярными выражениями заново
+        self._parse_cached = lru_cache(maxsize=512)(self._parse_message_impl)
+        
+        # Полные названия культур и операций по сокращению: различных сокращений
+        # немного, а при сборке отчета они запрашиваются для каждой строки
+        self._culture_cached = lru_cache(maxsize=1024)(self._normalize_culture_impl)
+        self._operation_cached = lru_cache(maxsize=1024)(self._operation_name_impl)
+        
+        # Открытые документы Word: путь -> (документ, число несохраненных сообщений).
+        # Блокировка нужна, так как Excel собирается в отдельном потоке
+        self._doc_cache: Dict[str, Tuple[Any, int]] = {}
+        self._doc_lock = threading.Lock()
+        
+        # Недавние сообщения: ключ текста -> время получения (time.monotonic)
+        self._recent_messages = LRUCache(maxsize=256)
+        
+        # Кэш анализа на диске (analysis_cache.jsonl, по записи {"k": ключ, "v": анализ}
+        # в строке, новые записи дописываются в конец) и его копия в памяти:
+        # ((mtime_ns, размер) файла, словарь). Файл перечитывается, только если изменился
+        self.analysis_cache_file = os.path.join(self.base_path, "analysis_cache.jsonl")
+        # Прежний формат - один JSON-словарь; переносится в analysis_cache.jsonl при первой загрузке
+        self.legacy_analysis_cache_file = os.path.join(self.base_path, "analysis_cache.json")
+        self._analysis_cache: Optional[Tuple[Optional[Tuple[int, int]], Dict[str, Any]]] = None
+        # Записи, еще не дописанные в файл (см. flush_analysis_cache), и число строк в файле
+        self._analysis_cache_pending: Dict[str, Any] = {}
+        self._analysis_cache_lines = 0
+        self._analysis_cache_lock = threading.Lock()
+        
+        # Текст сохраненных документов Word: имя файла -> ((mtime_ns, размер), текст)
+        self._docx_text_cache: Dict[str, Tuple[Tuple[int, int], str]] = {}
     
     def load_reference_data(self):
         """
         Загружает справочные данные для классификации сообщений.
         Если файл справочных данных не найден, использует значения по умолчанию.
+        Разобранный файл общий для всех обработчиков процесса - не изменяйте его.
         """
-        reference_file = os.path.join(self.base_path, "reference_data.json")
+        reference_file = os.path.abspath(os.path.join(self.base_path, "reference_data.json"))
         
         try:
             if os.path.exists(reference_file):
-                with open(reference_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                # Файл читается заново, только если он изменился
+                data = _read_reference_file(reference_file, os.stat(reference_file).st_mtime_ns)
                 logging.info(f"Загружены справочные данные из {reference_file}")
                 return data
             else:
@@ -67,130 +600,13 @@ class FileHandler:
     
     def _get_default_reference_data(self):
         """
-        Возвращает значения справочных данных по умолчанию.
+        Возвращает значения справочных данных по умолчанию (общий объект - не изменяйте его).
         """
-        return {
-            "subdivisions": [
-                "Центральное отделение", 
-                "Северное отделение", 
-                "Южное отделение", 
-                "Восточное отделение", 
-                "Западное отделение",
-                "АО Кроноткинское",
-                "Восход",
-                "Колхоз Прогресс",
-                "Мир",
-                "СП Коломейцево"
-            ],
-            "operations": [
-                "Вспашка", 
-                "Боронование", 
-                "Культивация",
-                "Культивация предпосевная",
-                "Культивация сплошная",
-                "Дискование",
-                "Гербицидная обработка",
-                "Гербицидная обработка сплошная",
-                "Фунгицидная обработка", 
-                "Инсектицидная обработка", 
-                "Внесение удобрений", 
-                "Посев", 
-                "Уборка", 
-                "Кошение",
-                "Скашивание",
-                "Орошение",
-                "Опрыскивание",
-                "Сбор урожая",
-                "Транспортировка",
-                "Погрузка",
-                "Разгрузка",
-                "Плановое ТО",
-                "Внеплановый ремонт",
-                "Перегон техники"
-            ],
-            "cultures": [
-                "Вика+Тритикале", "Горох на зерно", "Горох товарный", "Гуар", "Конопля", 
-                "Кориандр", "Кукуруза кормовая", "Кукуруза семенная", "Кукуруза товарная", 
-                "Люцерна", "Многолетние злаковые травы", "Многолетние травы прошлых лет", 
-                "Многолетние травы текущего года", "Овес", "Подсолнечник кондитерский", 
-                "Подсолнечник семенной", "Подсолнечник товарный", "Просо", 
-                "Пшеница озимая на зеленый корм", "Пшеница озимая семенная", 
-                "Пшеница озимая товарная", "Рапс озимый", "Рапс яровой", "Свекла сахарная", 
-                "Сорго", "Сорго кормовой", "Сорго-суданковый гибрид", "Соя семенная", 
-                "Соя товарная", "Чистый пар", "Чумиза", "Ячмень озимый", "Ячмень озимый семенной"
-            ],
-            "pu_subdivisions": {
-                "АОР": ["Кавказ", "Север", "Центр", "Юг", "Рассвет"],
-                "ТСК": ["Нет ПУ"],
-                "АО Кроноткинское": ["Нет ПУ"],
-                "Восход": ["Нет ПУ"],
-                "Колхоз Прогресс": ["Нет ПУ"],
-                "Мир": ["Нет ПУ"],
-                "СП Коломейцево": ["Нет ПУ"]
-            },
-            "departments": {
-                "Кавказ": ["18", "19"],
-                "Север": ["3", "7", "10", "20"],
-                "Центр": ["1", "4", "5", "6", "9"],
-                "Юг": ["11", "12", "16", "17"],
-                "Рассвет": []
-            },
-            "operations_by_culture": {
-                "Пшеница озимая товарная": [
-                    "Пахота", "Дискование", "Выравнивание", "Предпосевная культивация", 
-                    "Сев", "Подкормка", "2-я подкормка", "Гербицидная обработка",
-                    "Фунгицидная обработка", "Уборка", "Прикатывание посевов"
-                ],
-                "Соя товарная": [
-                    "Пахота", "Дискование", "Предпосевная культивация", "Сев", 
-                    "Гербицидная обработка", "Междурядная обработка", "Уборка"
-                ],
-                "Подсолнечник товарный": [
-                    "Пахота", "Дискование", "Предпосевная культивация", "Сев", 
-                    "Гербицидная обработка", "Междурядная обработка", "Уборка"
-                ],
-                "Свекла сахарная": [
-                    "Пахота", "Дискование", "Предпосевная культивация", "Сев", 
-                    "Гербицидная обработка", "Междурядная обработка", "Уборка"
-                ],
-                "Многолетние травы": [
-                    "Пахота", "Дискование", "Предпосевная культивация", "Сев", 
-                    "Уборка", "Подкормка"
-                ]
-            },
-            "culture_abbreviations": {
-                "мн тр": "Многолетние травы прошлых лет",
-                "мн тр тек.года": "Многолетние травы текущего года",
-                "мн зл": "Многолетние злаковые травы",
-                "оз пш": "Пшеница озимая товарная",
-                "оз пш сем": "Пшеница озимая семенная",
-                "оз пш на зел": "Пшеница озимая на зеленый корм",
-                "сах св": "Свекла сахарная",
-                "соя": "Соя товарная",
-                "соя сем": "Соя семенная",
-                "подс": "Подсолнечник товарный",
-                "подс сем": "Подсолнечник семенной",
-                "подс кон": "Подсолнечник кондитерский",
-                "яч": "Ячмень озимый", 
-                "оз яч": "Ячмень озимый",
-                "оз яч сем": "Ячмень озимый семенной",
-                "кук": "Кукуруза товарная",
-                "кук корм": "Кукуруза кормовая",
-                "кук сем": "Кукуруза семенная",
-                "рапс": "Рапс яровой",
-                "оз рапс": "Рапс озимый",
-                "горох": "Горох на зерно",
-                "горох тов": "Горох товарный",
-                "вика+трит": "Вика+Тритикале",
-                "сорго": "Сорго",
-                "сорго корм": "Сорго кормовой",
-                "гибрид": "Сорго-суданковый гибрид"
-            }
-        }
+        return DEFAULT_REFERENCE_DATA
     
     async def save_message(self, sender_name: str, message_text: str, yandex_gpt=None) -> Tuple[str, Dict[str, Any]]:
         """
-        Сохраняет сообщение в файл Word, анализирует с помощью YandexGPT и обновляет Excel
+        Сохраняет сообщение в файл Word и анализирует его с помощью YandexGPT
         
         Args:
             sender_name (str): имя отправителя
@@ -198,8 +614,28 @@ class FileHandler:
             yandex_gpt: экземпляр класса YandexGPT
             
         Returns:
-            Tuple[str, Dict[str, Any]]: (путь к сохраненному файлу, результат анализа)
+            Tuple[str, Dict[str, Any]]: (путь к сохраненному файлу, результат анализа);
+                ("", {}), если сообщение - повтор недавнего и не сохранялось
         """
+        # Повторная пересылка того же текста тем же отправителем в течение DUPLICATE_WINDOW
+        # секунд не записывается второй раз: ни в Word, ни в статистику, ни в Excel.
+        # Одинаковые отчеты разных агрономов - разные сообщения
+        message_key = (sender_name, exact_text_key(message_text))
+        received_at = time.monotonic()
+        seen_at = self._recent_messages.get(message_key)
+        duplicate = seen_at is not None and received_at - seen_at < DUPLICATE_WINDOW
+        if not duplicate:
+            self._recent_messages.put(message_key, received_at)
+        
+        # Формируем имя файла для текущего дня
+        now = datetime.now()
+        filename = f"messages_{format_day(now.date(), '%d%m%Y')}.docx"
+        filepath = os.path.join(self.messages_path, filename)
+        
+        if duplicate:
+            logging.info("Повтор недавнего сообщения от %s: запись в Word и Excel пропущена", sender_name)
+            return "", {}
+        
         # Увеличиваем счетчик сообщений для отправителя
         if sender_name not in self.message_counters:
             self.message_counters[sender_name] = 0
@@ -211,46 +647,27 @@ class FileHandler:
             self.statistics["senders"][sender_name] = 0
         self.statistics["senders"][sender_name] += 1
         
-        # Формируем имя файла для текущего дня
-        now = datetime.now()
-        filename = f"messages_{now.strftime('%d%m%Y')}.docx"
-        filepath = os.path.join(self.messages_path, filename)
-        
         try:
-            # Если файл существует, открываем его
-            if os.path.exists(filepath):
-                doc = Document(filepath)
-            else:
-                # Создаем новый документ
-                doc = Document()
-                # Добавляем заголовок
-                doc.add_heading(f'Сообщения агрономов за {now.strftime("%d.%m.%Y")}', 0)
-            
-            # Добавляем информацию о сообщении
-            doc.add_heading(f'{sender_name} - {now.strftime("%H:%M")}', level=2)
-            doc.add_paragraph(message_text)
-            doc.add_paragraph('') # Пустая строка для разделения сообщений
+            # Запись в Word идет в отдельном потоке параллельно с запросом к YandexGPT
+            docx_task = asyncio.create_task(asyncio.to_thread(self._write_docx, filepath, sender_name, message_text, now))
             
-            # Сохраняем документ
-            doc.save(filepath)
-            logging.info(f"Сообщение добавлено в файл: {filepath}")
+            analysis_result = await self._analyze_for_save(sender_name, message_text, yandex_gpt)
             
-        except Exception as e:
-            logging.error(f"Ошибка при сохранении сообщения в Word: {str(e)}")
-            # В случае ошибки создаем новый файл
-            try:
-                doc = Document()
-                doc.add_heading(f'Сообщения агрономов за {now.strftime("%d.%m.%Y")}', 0)
-                doc.add_heading(f'{sender_name} - {now.strftime("%H:%M")}', level=2)
-                doc.add_paragraph(message_text)
-                doc.add_paragraph('')
-                doc.save(filepath)
-                logging.info(f"Создан новый файл с сообщением: {filepath}")
-            except Exception as e:
-                logging.error(f"Критическая ошибка при создании нового файла Word: {str(e)}")
-                raise
+            # Ошибка записи в Word пробрасывается так же, как раньше
+            await docx_task
+        except BaseException:
+            # Сообщение не сохранено: повторная отправка не должна считаться дубликатом.
+            # Ключ записывается до сохранения, чтобы параллельные обработчики видели его сразу
+            self._recent_messages.discard(message_key)
+            raise
+        
+        # Excel пересобирается фоновой задачей бота по версии данных
+        self.data_version += 1
         
-        # Анализируем сообщение, если предоставлен экземпляр YandexGPT
+        return filepath, analysis_result
+    
+    async def _analyze_for_save(self, sender_name: str, message_text: str, yandex_gpt) -> Dict[str, Any]:
+        """Анализирует сообщение, если предоставлен экземпляр YandexGPT"""
         analysis_result = {}
         if yandex_gpt:
             try:
@@ -259,87 +676,119 @@ class FileHandler:
                 logging.error(f"Ошибка при анализе сообщения: {str(e)}")
                 # Используем обычный парсинг при ошибке
                 analysis_result = self.parse_message(message_text)
-        
-        # Автоматически обновляем Excel после каждого сообщения
-        try:
-            self.update_excel()
-        except Exception as e:
-            logging.error(f"Ошибка при автоматическом обновлении Excel: {str(e)}")
-        
-        return filepath, analysis_result
+        return analysis_result
+    
+    def _write_docx(self, filepath: str, sender_name: str, message_text: str, now: datetime) -> None:
+        """Добавляет сообщение в документ Word за день (блокирующая операция)"""
+        from docx import Document
+        with self._doc_lock:
+            try:
+                doc, unsaved = self._doc_cache.get(filepath, (None, 0))
+                if doc is None:
+                    # Начался новый день: дописываем и забываем документы прошлых дней
+                    self._flush_documents_locked()
+                    self._doc_cache.clear()
+                    # Если файл существует, открываем его (один раз за день)
+                    if os.path.exists(filepath):
+                        doc = Document(filepath)
+                    else:
+                        # Создаем новый документ
+                        doc = Document()
+                        # Добавляем заголовок
+                        doc.add_heading(f'Сообщения агрономов за {format_day(now.date(), "%d.%m.%Y")}', 0)
+                
+                # Добавляем информацию о сообщении
+                _append_message(doc, f'{sender_name} - {now.hour:02d}:{now.minute:02d}', message_text)
+                
+                # Сохраняем документ не после каждого сообщения, а пачками
+                unsaved += 1
+                if unsaved >= DOCX_SAVE_EVERY:
+                    doc.save(filepath)
+                    unsaved = 0
+                self._doc_cache[filepath] = (doc, unsaved)
+                logging.info(f"Сообщение добавлено в файл: {filepath}")
+                
+            except Exception as e:
+                logging.error(f"Ошибка при сохранении сообщения в Word: {str(e)}")
+                # В случае ошибки создаем новый файл
+                self._doc_cache.pop(filepath, None)
+                try:
+                    doc = Document()
+                    doc.add_heading(f'Сообщения агрономов за {format_day(now.date(), "%d.%m.%Y")}', 0)
+                    _append_message(doc, f'{sender_name} - {now.hour:02d}:{now.minute:02d}', message_text)
+                    doc.save(filepath)
+                    self._doc_cache[filepath] = (doc, 0)
+                    logging.info(f"Создан новый файл с сообщением: {filepath}")
+                except Exception as e:
+                    logging.error(f"Критическая ошибка при создании нового файла Word: {str(e)}")
+                    raise
+    
+    def flush_documents(self) -> None:
+        """Сохраняет на диск документы Word с несохраненными сообщениями"""
+        with self._doc_lock:
+            self._flush_documents_locked()
+    
+    def _flush_documents_locked(self) -> None:
+        """То же, что flush_documents; вызывается при захваченной блокировке"""
+        for filepath, (doc, unsaved) in self._doc_cache.items():
+            if unsaved:
+                doc.save(filepath)
+                self._doc_cache[filepath] = (doc, 0)
     
     def parse_message(self, message_text: str) -> Dict[str, Any]:
         """
         Анализирует текст сообщения и извлекает нужную информацию
         
+        Результат кэшируется и общий для одинаковых сообщений за день - не изменяйте его.
+        
         Args:
             message_text (str): текст сообщения
             
         Returns:
             Dict[str, Any]: извлеченные данные
         """
-        # Инициализируем базовые поля
-        data = {
-            "work_type": "",
-            "operation": "",
-            "culture_from": "",
-            "culture_to": "",
-            "pu_number": "",
-            "pu_area": "",
-            "department": "",
-            "department_number": "",
-            "department_area": "",
-            "date": "",
-            "subdivision": "АОР",
-            "val_day": "",
-            "val_total": "",
-            "date_processed": datetime.now().strftime("%d.%m.%Y")
-        }
+        # День входит в ключ: от него зависят date_processed и год в датах
+        return self._parse_cached(message_text, date.today())
+    
+    def _parse_message_impl(self, message_text: str, day: date) -> Dict[str, Any]:
+        """Базовый разбор сообщения регулярными выражениями (без кэша)"""
+        # Инициализируем базовые поля (копия шаблона вместо сборки словаря заново)
+        data = dict(EMPTY_OPERATION, date_processed=format_day(day, "%d.%m.%Y"))
         
         try:
             # Разбиваем сообщение на строки и операции
             operations = []
             current_operation = None
-            lines = message_text.strip().split('\n')
-            
-            # Шаблоны регулярных выражений для извлечения данных
-            patterns = {
-                "field_info": r"(?:Предп|диск|Пахота|Выравн)(?:ов|п)?(?:ание|а|)?\s+(\w+(?:\s+\w+)?)\s+(?:под|на)?\s*(\w+(?:\s+\w+)?)?",
-                "pu_info": r"По\s*Пу\s*(\d+)/(\d+)",
-                "department_info": r"Отд\s*(\d+)\s*(\d+)/(\d+)",
-                "date": r"(\d{1,2}\.\d{1,2}(?:\.\d{4})?)",
-                "operation": r"^([А-Яа-я0-9\-\s]+)(?:\n|$)",
-                "val_day": r"Вал\s+за\s+день\s+(\d+[\s,\.]\d+)",
-                "val_total": r"Вал\s+с\s+начала\s+(\d+[\s,\.]\d+)"
-            }
+            # Строки обрезаются и приводятся к нижнему регистру один раз на сообщение
+            lines = [line.strip() for line in message_text.strip().split('\n')]
+            lines_lower = [line.lower() for line in lines]
             
             # Обработка заголовка сообщения для поиска даты и подразделения
-            for i, line in enumerate(lines):
-                date_match = re.search(patterns["date"], line)
+            for line, line_lower in zip(lines, lines_lower):
+                date_match = DATE_RE.search(line)
                 if date_match:
                     date = date_match.group(1)
                     if len(date.split('.')) == 2:
-                        date += f".{datetime.now().year}"
+                        date += f".{day.year}"
                     data["date"] = date
                 
                 # Поиск подразделения в начале сообщения
-                for sub in self.reference_data["subdivisions"]:
-                    if sub.lower() in line.lower():
-                        data["subdivision"] = sub
-                        break
+                # Одно выражение отсекает строки без подразделений; если совпадение есть,
+                # берем первое подразделение по порядку справочника, как и раньше
+                if self._subdivisions_re.search(line_lower):
+                    for sub_lower, sub in self._subdivisions_lower:
+                        if sub_lower in line_lower:
+                            data["subdivision"] = sub
+                            break
             
             # Режим обработки - операция по операции
-            i = 0
-            while i < len(lines):
-                line = lines[i].strip()
-                
+            for line in lines:
                 if not line:
-                    i += 1
                     continue
                 
                 # Проверяем, является ли строка операцией
-                operation_match = re.search(patterns["operation"], line)
-                culture_match = re.search(patterns["field_info"], line)
+                operation_match = OPERATION_RE.search(line)
+                culture_match = FIELD_INFO_RE.search(line)
                 
                 if operation_match or (culture_match and "под" in line):
                     # Начало новой операции
@@ -359,37 +808,35 @@ class FileHandler:
                         if culture_match.group(2):
                             current_operation["culture_to"] = self.normalize_culture_abbreviation(culture_match.group(2))
                 
-                # Проверяем информацию о ПУ
-                pu_match = re.search(patterns["pu_info"], line)
-                if pu_match:
-                    if current_operation:
-                        current_operation["pu_number"] = pu_match.group(1)
-                        current_operation["pu_area"] = pu_match.group(2)
-                
-                # Проверяем информацию об отделах
-                dept_match = re.search(patterns["department_info"], line)
-                if dept_match:
-                    if current_operation:
-                        if not current_operation["department"]:
-                            current_operation["department"] = dept_match.group(1)
-                            current_operation["department_number"] = dept_match.group(2)
-                            current_operation["department_area"] = dept_match.group(3)
+                # ПУ, отделы и вал ищутся одним проходом по строке; как и раньше,
+                # из каждой строки берется только первое совпадение каждого вида
+                if current_operation:
+                    seen = set()
+                    for match in LINE_FIELDS_RE.finditer(line):
+                        kind = match.lastgroup
+                        if kind in seen:
+                            continue
+                        seen.add(kind)
+                        
+                        if kind == "pu":
+                            # Информация о ПУ
+                            current_operation["pu_number"] = match.group("pu_number")
+                            current_operation["pu_area"] = match.group("pu_area")
+                        elif kind == "dept":
+                            # Информация об отделах
+                            if not current_operation["department"]:
+                                current_operation["department"] = match.group("department")
+                                current_operation["department_number"] = match.group("department_number")
+                                current_operation["department_area"] = match.group("department_area")
+                            else:
+                                # Добавляем через запятую, если уже есть отделы
+                                current_operation["department"] += f", {match.group('department')}"
+                                current_operation["department_number"] += f", {match.group('department_number')}"
+                                current_operation["department_area"] += f", {match.group('department_area')}"
+                        elif kind == "val_day":
+                            current_operation["val_day"] = match.group("val_day_value").replace(" ", "")
                         else:
-                            # Добавляем через запятую, если уже есть отделы
-                            current_operation["department"] += f", {dept_match.group(1)}"
-                            current_operation["department_number"] += f", {dept_match.group(2)}"
-                            current_operation["department_area"] += f", {dept_match.group(3)}"
-                
-                # Проверяем информацию о вале
-                val_day_match = re.search(patterns["val_day"], line)
-                if val_day_match and current_operation:
-                    current_operation["val_day"] = val_day_match.group(1).replace(" ", "")
-                
-                val_total_match = re.search(patterns["val_total"], line)
-                if val_total_match and current_operation:
-                    current_operation["val_total"] = val_total_match.group(1).replace(" ", "")
-                
-                i += 1
+                            current_operation["val_total"] = match.group("val_total_value").replace(" ", "")
             
             # Добавляем последнюю операцию, если она есть
             if current_operation:
@@ -403,10 +850,7 @@ class FileHandler:
                 }
                 
                 # Для совместимости с другими методами, добавляем поля первой операции
-                if operations:
-                    for key, value in operations[0].items():
-                        if key != "operations":
-                            result[key] = value
+                result.update(operations[0])
                 
                 return result
             
@@ -415,19 +859,19 @@ class FileHandler:
             
             # Проверяем наличие операции в первой строке
             if lines and lines[0]:
-                operation_match = re.search(r"^([А-Яа-я\s\-]+)", lines[0])
+                operation_match = OPERATION_FALLBACK_RE.search(lines[0])
                 if operation_match:
                     operation["work_type"] = operation_match.group(1).strip()
                     operation["operation"] = operation_match.group(1).strip()
             
             # Ищем информацию о ПУ и отделах во всем сообщении
             for line in lines:
-                pu_match = re.search(patterns["pu_info"], line)
+                pu_match = PU_RE.search(line)
                 if pu_match:
                     operation["pu_number"] = pu_match.group(1)
                     operation["pu_area"] = pu_match.group(2)
                 
-                dept_match = re.search(patterns["department_info"], line)
+                dept_match = DEPT_RE.search(line)
                 if dept_match:
                     if not operation["department"]:
                         operation["department"] = dept_match.group(1)
@@ -457,86 +901,15 @@ class FileHandler:
         Returns:
             Dict[str, Any]: извлеченные данные
         """
-        # Примеры для обучения - показываем модели, как обрабатывать сообщения
-        examples = [
-            {
-                "message": "Пахота зяби под мн тр\nПо Пу 26/488\nОтд 12 26/221",
-                "analysis": {
-                    "work_type": "Пахота", 
-                    "operation": "Пахота зяби", 
-                    "culture_from": "зяби", 
-                    "culture_to": "Многолетние", 
-                    "pu_number": "26", 
-                    "pu_area": "488", 
-                    "department": "12", 
-                    "department_number": "26", 
-                    "department_area": "221",
-                    "date": "",
-                    "subdivision": "АОР",
-                    "val_day": "",
-                    "val_total": ""
-                }
-            },
-            {
-                "message": "Предп культ под оз пш\nПо Пу 215/1015\nОтд 12 128/317\nОтд 16 123/529",
-                "analysis": {
-                    "work_type": "Предпосевная культивация",
-                    "operation": "Предп культ",
-                    "culture_from": "культ",
-                    "culture_to": "Пшеница озимая товарная",
-                    "pu_number": "215",
-                    "pu_area": "1015",
-                    "department": "12, 16",
-                    "department_number": "128, 123",
-                    "department_area": "317, 529",
-                    "date": "",
-                    "subdivision": "АОР",
-                    "val_day": "",
-                    "val_total": ""
-                }
-            },
-            {
-                "message": "10.03 день\n2-я подкормка\nПо Пу 1749/2559",
-                "analysis": {
-                    "work_type": "2-я подкормка",
-                    "operation": "2-я подкормка",
-                    "culture_from": "",
-                    "culture_to": "Пшеница озимая товарная",
-                    "pu_number": "1749",
-                    "pu_area": "2559",
-                    "department": "",
-                    "department_number": "",
-                    "department_area": "",
-                    "date": "10.03.2024",
-                    "subdivision": "АОР",
-                    "val_day": "",
-                    "val_total": ""
-                }
-            }
-        ]
-        
-        # Формируем список справочных данных для модели
-        reference_data_str = json.dumps({
-            "subdivisions": list(self.reference_data["subdivisions"]),
-            "operations": list(self.reference_data["operations"]),
-            "cultures": list(self.reference_data["cultures"])
-        }, ensure_ascii=False)
-        
-        # Формируем примеры для обучения
-        examples_str = "\n\n".join([
-            f"СООБЩЕНИЕ: {ex['message']}\nАНАЛИЗ: {json.dumps(ex['analysis'], ensure_ascii=False)}"
-            for ex in examples[:2]  # Используем только первые два примера для сокращения запроса
-        ])
-        
         # Улучшенный промпт с примерами и справочными данными
         prompt = f"""
         Ты - специализированная система для анализа сельскохозяйственных сообщений от агрономов.
         
         СПРАВОЧНЫЕ ДАННЫЕ:
-        {reference_data_str}
+        {self._reference_data_str}
         
         ПРИМЕРЫ АНАЛИЗА:
-        {examples_str}
+        {GPT_EXAMPLES_STR}
         
         Теперь проанализируй следующее сообщение от агронома и извлеки из него все структурированные данные.
         Сообщение может содержать одну или несколько операций. Каждая операция обычно включает:
@@ -571,37 +944,24 @@ class FileHandler:
                 logging.warning(f"YandexGPT вернул ошибку: {response_text}")
                 return self.parse_message(message_text)
             
-            # Извлекаем JSON из ответа
-            json_str = response_text.strip()
-            
-            # Чистим ответ для получения валидного JSON
-            # Очищаем строку от маркеров кода, если они есть
-            if "```json" in json_str:
-                json_str = json_str.split("```json")[1].split("```")[0].strip()
-            elif "```" in json_str:
-                json_str = json_str.split("```")[1].strip()
-                
-            # Удаляем все, что не является JSON
-            if not json_str.startswith('{'):
-                start_idx = json_str.find('{')
-                if start_idx == -1:
-                    logging.error("Не удалось найти JSON в ответе")
-                    return self.parse_message(message_text)
-                json_str = json_str[start_idx:]
-            
-            if not json_str.endswith('}'):
-                end_idx = json_str.rfind('}')
-                if end_idx == -1:
-                    logging.error("Не удалось найти конец JSON в ответе")
-                    return self.parse_message(message_text)
-                json_str = json_str[:end_idx+1]
+            # Извлекаем JSON из ответа: убираем маркеры кода и разбираем первый
+            # полный объект, начиная с первой "{" (текст после него игнорируется)
+            json_str = CODE_FENCE_RE.sub("", response_text)
+            start_idx = json_str.find('{')
+            if start_idx == -1:
+                logging.error("Не удалось найти JSON в ответе")
+                return self.parse_message(message_text)
             
             try:
-                # Парсим JSON
-                data = json.loads(json_str)
+                # Парсим JSON. Обычно ответ - ровно один объект, его разбирает orjson;
+                # если после объекта есть лишний текст, первый объект разбирает raw_decode
+                try:
+                    data = orjson.loads(json_str[start_idx:json_str.rfind('}') + 1])
+                except orjson.JSONDecodeError:
+                    data, _ = ANALYSIS_JSON_DECODER.raw_decode(json_str, start_idx)
                 logging.info(f"Успешно получен и разобран JSON ответ от YandexGPT")
             except json.JSONDecodeError as e:
-                logging.error(f"Ошибка при парсинге JSON: {e}. JSON: {json_str[:200]}...")
+                logging.error(f"Ошибка при парсинге JSON: {e}. JSON: {json_str[start_idx:start_idx+200]}...")
                 return self.parse_message(message_text)
             
             # Извлекаем первую операцию, если это массив операций
@@ -631,13 +991,13 @@ class FileHandler:
                 
                 # Добавляем дату обработки, если нет даты
                 if not result_data["date"]:
-                    result_data["date_processed"] = datetime.now().strftime("%d.%m.%Y")
+                    result_data["date_processed"] = format_day(date.today(), "%d.%m.%Y")
                 
                 return result_data
             else:
                 # Если операций нет, заполняем базовые поля
                 basic_data = {
-                    "date_processed": datetime.now().strftime("%d.%m.%Y"),
+                    "date_processed": format_day(date.today(), "%d.%m.%Y"),
                     "operations": []
                 }
                 
@@ -664,8 +1024,15 @@ class FileHandler:
         if not os.path.exists(self.messages_path):
             return messages
             
-        for filename in os.listdir(self.messages_path):
-            if filename.endswith(".docx"):
+        # Новый кэш собирается заново, так что записи удаленных файлов в нем не остаются
+        text_cache = {}
+        # Файлы, текст которых нужно прочитать заново: (индекс в messages, имя, путь, отметка)
+        pending = []
+        with os.scandir(self.messages_path) as entries:
+            for entry in entries:
+                filename = entry.name
+                if not filename.endswith(".docx"):
+                    continue
                 try:
                     # Извлекаем имя отправителя и дату из имени файла
                     parts = filename.split("_")
@@ -677,83 +1044,162 @@ class FileHandler:
                             date_obj = datetime.strptime(date_str, "%M%H%d%m%Y")
                             date_str = date_obj.strftime("%d.%m.%Y")
                         except:
-                            date_str = datetime.now().strftime("%d.%m.%Y")
+                            date_str = format_day(date.today(), "%d.%m.%Y")
                     else:
-                        date_str = datetime.now().strftime("%d.%m.%Y")
+                        date_str = format_day(date.today(), "%d.%m.%Y")
                     
-                    # Читаем текст из файла
-                    filepath = os.path.join(self.messages_path, filename)
-                    doc = Document(filepath)
-                    text = "\n".join([para.text for para in doc.paragraphs])
-                    
-                    messages.append((sender_name, date_str, text))
+                    # Разобранный текст кэшируется, пока файл не изменился (документ за
+                    # день перезаписывается на месте, поэтому проверяем время изменения
+                    # и размер самого файла, а не каталога)
+                    st = entry.stat()
+                    stamp = (st.st_mtime_ns, st.st_size)
+                    cached = self._docx_text_cache.get(filename)
+                    if cached is not None and cached[0] == stamp:
+                        text_cache[filename] = cached
+                        messages.append((sender_name, date_str, cached[1]))
+                    else:
+                        pending.append((len(messages), filename, entry.path, stamp))
+                        messages.append((sender_name, date_str, None))
+                except Exception as e:
+                    logging.error("Ошибка при чтении файла %s: %s", filename, e)
+        
+        # Много измененных документов читаем в общем пуле потоков: файлы независимы,
+        # а распаковка zip и разбор XML частично идут без GIL
+        if pending:
+            if len(pending) > DOCX_SEQUENTIAL_MAX:
+                pool = _docx_read_pool()
+                futures = [pool.submit(_read_docx_text, path) for _, _, path, _ in pending]
+            else:
+                futures = None
+            failed = set()
+            for position, (index, filename, path, stamp) in enumerate(pending):
+                try:
+                    text = futures[position].result() if futures is not None else _read_docx_text(path)
                 except Exception as e:
-                    print(f"Ошибка при чтении файла {filename}: {e}")
+                    logging.error("Ошибка при чтении файла %s: %s", filename, e)
+                    failed.add(index)
+                    continue
+                text_cache[filename] = (stamp, text)
+                sender_name, date_str, _ = messages[index]
+                messages[index] = (sender_name, date_str, text)
+            if failed:
+                messages = [msg for index, msg in enumerate(messages) if index not in failed]
+        self._docx_text_cache = text_cache
         
         return messages
     
-    def update_excel(self, template_path: str = None) -> str:
+    def update_excel(self, template_path: str = None, include_legend: bool = True) -> str:
         """
         Обновляет Excel файл с данными из всех сообщений
         
         Args:
             template_path (str, optional): путь к шаблону Excel
+            include_legend (bool): добавить в начало листа легенду с цветовыми обозначениями
             
         Returns:
             str: путь к сохраненному файлу
         """
-        # Создаем новую книгу Excel каждый раз
-        wb = openpyxl.Workbook()
-        # Удаляем стандартный лист
-        std_sheet = wb.active
-        wb.remove(std_sheet)
-        # Создаем новый лист с именем
+        import openpyxl
+        from openpyxl.cell import WriteOnlyCell
+        header_fill, legend_fills, bold_font = _excel_styles()
+        
+        # Получаем список всех сообщений (сначала дописываем документы из памяти)
+        self.flush_documents()
+        
+        # Если с прошлой сборки входные данные не менялись, отчет уже готов
+        if (self._excel_fingerprint_last == self._excel_fingerprint(include_legend)
+                and self.current_excel_path and os.path.exists(self.current_excel_path)):
+            logging.info("Данные не изменились, используется готовый отчет %s", self.current_excel_path)
+            return self.current_excel_path
+        
+        rows = self._collect_rows(self.get_all_messages())
+        
+        # Книга пишется в потоковом режиме (write_only): строки сразу сериализуются,
+        # а не хранятся в памяти как объекты ячеек
+        wb = openpyxl.Workbook(write_only=True)
         ws = wb.create_sheet("Отчет агрономов")
         
-        # Задаем стили для ячеек
-        header_fill = PatternFill(start_color="E2EFDA", end_color="E2EFDA", fill_type="solid")
-        date_fill = PatternFill(start_color="D9E1F2", end_color="D9E1F2", fill_type="solid")
-        subdivision_fill = PatternFill(start_color="5B9BD5", end_color="5B9BD5", fill_type="solid") 
-        operation_fill = PatternFill(start_color="FF0000", end_color="FF0000", fill_type="solid")
-        culture_fill = PatternFill(start_color="9933FF", end_color="9933FF", fill_type="solid")
-        day_area_fill = PatternFill(start_color="FF9966", end_color="FF9966", fill_type="solid")
-        total_area_fill = PatternFill(start_color="00FF00", end_color="00FF00", fill_type="solid")
-        day_val_fill = PatternFill(start_color="FF99CC", end_color="FF99CC", fill_type="solid")
-        total_val_fill = PatternFill(start_color="99FF99", end_color="99FF99", fill_type="solid")
-        
-        # Добавляем раздел легенда в начало файла
-        ws.cell(row=1, column=2).value = "Легенда"
-        ws.merge_cells('B1:I1')
-        
-        ws.cell(row=2, column=1).value = "Цветовое обозначение"
-        ws.merge_cells('A2:A3')
-        
-        # Добавляем заголовки колонок с цветами
-        headers = ["Дата", "Подразделение", "Операция", "Культура", "За день, га", "С начала операции, га", "Вал за день, ц", "Вал с начала, ц"]
-        fills = [date_fill, subdivision_fill, operation_fill, culture_fill, day_area_fill, total_area_fill, day_val_fill, total_val_fill]
-        
-        for col, (header, fill) in enumerate(zip(headers, fills), 2):
-            ws.cell(row=2, column=col).value = header
-            ws.cell(row=2, column=col).fill = fill
-            ws.cell(row=3, column=col).fill = fill
+        # Ширину колонок и объединения нужно задать до записи строк
+        column_dimensions = ws.column_dimensions
+        for letter, width in EXCEL_COLUMN_WIDTHS.items():
+            column_dimensions[letter].width = width
+        # B1:I1 - заголовок легенды или, без нее, заголовок фактических данных
+        ws.merged_cells.add("B1:I1")
+        if include_legend:
+            ws.merged_cells.add("A2:A3")
+            ws.merged_cells.add("B5:I5")
+        
+        def styled(value=None, fill=None, font=None):
+            cell = WriteOnlyCell(ws, value=value)
+            if fill is not None:
+                cell.fill = fill
+            if font is not None:
+                cell.font = font
+            return cell
+        
+        if include_legend:
+            # Добавляем раздел легенда в начало файла
+            ws.append([None, "Легенда"])
+            
+            # Заголовки колонок с цветами
+            ws.append(["Цветовое обозначение"] + [styled(header, fill) for header, fill in zip(EXCEL_HEADERS, legend_fills)])
+            ws.append([None] + [styled(fill=fill) for fill in legend_fills])
+            ws.append([])
         
         # Добавляем заголовок фактических данных
-        current_row = 5
-        ws.cell(row=current_row, column=2).value = "Фактические данные"
-        ws.cell(row=current_row, column=2).font = Font(bold=True)
-        ws.merge_cells(start_row=current_row, start_column=2, end_row=current_row, end_column=9)
+        ws.append([None, styled("Фактические данные", font=bold_font)])
         
         # Заголовки для фактических данных
-        current_row += 1
-        for col, header in enumerate(headers, 2):
-            ws.cell(row=current_row, column=col).value = header
-            ws.cell(row=current_row, column=col).fill = header_fill
+        ws.append([None] + [styled(header, header_fill) for header in EXCEL_HEADERS])
         
-        # Получаем все сообщения и их анализы
-        current_row += 1
+        # Строки отчета собираются заранее и затем пишутся подряд
+        self._write_rows(ws, rows)
         
-        # Получаем список всех сообщений
-        messages = self.get_all_messages()
+        # Сохраняем файл в папку data/excel с названием, включающим дату и время
+        now = datetime.now()
+        date_str = now.strftime("%d.%m.%Y_%H-%M-%S")
+        excel_dir = os.path.join('data', 'excel')
+        ensure_dir(excel_dir)
+        excel_path = os.path.join(excel_dir, f"Отчет_агрономов_{date_str}.xlsx")
+        
+        wb.save(excel_path)
+        
+        # Результаты базового парсера, добавленные в кэш анализа по ходу сборки, пишем одним разом
+        self.flush_analysis_cache()
+        
+        # Обновляем последний путь в статистике; отпечаток снимаем после записи кэша анализа
+        self.update_stats_with_excel(excel_path)
+        self._excel_fingerprint_last = self._excel_fingerprint(include_legend)
+        
+        return excel_path
+    
+    def _excel_fingerprint(self, include_legend: bool) -> Tuple[Any, ...]:
+        """
+        Отпечаток входных данных отчета: документы сообщений (имя, mtime_ns, размер),
+        файл кэша анализа, текущий день (подставляется в строки без даты) и вид листа
+        """
+        documents = []
+        if os.path.isdir(self.messages_path):
+            with os.scandir(self.messages_path) as entries:
+                for entry in entries:
+                    st = entry.stat()
+                    documents.append((entry.name, st.st_mtime_ns, st.st_size))
+        documents.sort()
+        with self._analysis_cache_lock:
+            cache_stamp = self._analysis_cache_stamp()
+        return (tuple(documents), cache_stamp, date.today(), include_legend)
+        
+    def _collect_rows(self, messages: List[Tuple[str, str, str]]) -> List[Tuple[Any, ...]]:
+        """
+        Собирает строки отчета по всем сообщениям
+        
+        Args:
+            messages (List[Tuple[str, str, str]]): сообщения из get_all_messages
+            
+        Returns:
+            List[Tuple[Any, ...]]: значения колонок B-I, по строке на операцию
+        """
+        rows = []
         
         # Анализируем каждое сообщение
         for sender_name, date_str, message_text in messages:
@@ -797,100 +1243,71 @@ class FileHandler:
                     elif not operation_date:
                         operation_date = date_str
                     
-                    # Заполняем строку данными
-                    ws.cell(row=current_row, column=2).value = operation_date
-                    ws.cell(row=current_row, column=3).value = op.get("subdivision", "АОР")
-                    ws.cell(row=current_row, column=4).value = operation_name
-                    ws.cell(row=current_row, column=5).value = culture
-                    ws.cell(row=current_row, column=6).value = op.get("pu_area", "")
-                    ws.cell(row=current_row, column=7).value = op.get("total_area", op.get("pu_area", ""))
-                    ws.cell(row=current_row, column=8).value = op.get("val_day", "")
-                    ws.cell(row=current_row, column=9).value = op.get("val_total", "")
-                    
-                    current_row += 1
-        
-        # Настраиваем ширину колонок
-        for col in range(1, 10):
-            if col == 1:
-                ws.column_dimensions[get_column_letter(col)].width = 40
-            else:
-                ws.column_dimensions[get_column_letter(col)].width = 20
-        
-        # Сохраняем файл в папку data/excel с названием, включающим дату и время
-        now = datetime.now()
-        date_str = now.strftime("%d.%m.%Y_%H-%M-%S")
-        excel_dir = os.path.join('data', 'excel')
-        os.makedirs(excel_dir, exist_ok=True)
-        excel_path = os.path.join(excel_dir, f"Отчет_агрономов_{date_str}.xlsx")
-        
-        wb.save(excel_path)
-        
-        # Обновляем последний путь в статистике
-        self.update_stats_with_excel(excel_path)
-        
-        return excel_path
-        
+                    # Заполняем строку данными (колонки B-I)
+                    rows.append((
+                        operation_date,
+                        op.get("subdivision", "АОР"),
+                        operation_name,
+                        culture,
+                        op.get("pu_area", ""),
+                        op.get("total_area", op.get("pu_area", "")),
+                        op.get("val_day", ""),
+                        op.get("val_total", "")
+                    ))
+        
+        return rows
+    
+    def _write_rows(self, ws, rows: List[Tuple[Any, ...]]) -> None:
+        """Дописывает строки отчета в лист; колонка A остается пустой"""
+        append = ws.append
+        for row in rows:
+            append((None, *row))
+    
     def add_excel_row_with_format(self, ws, row: int, date: str, subdivision: str, operation: str, 
                         culture: str, day_area: str, total_area: str, day_val: str = "", 
                         total_val: str = ""):
         """Добавляет строку в таблицу Excel с форматированием"""
-        # Массив колонок (начиная с B, так как A зарезервирована для примеров)
-        columns = list(range(2, 10))  # B to I
+        # Добавляем значения в ячейки (колонки B-I, так как A зарезервирована для примеров);
+        # значение передается сразу в ws.cell, без отдельного присваивания
+        values = (date, subdivision, operation, culture, day_area, total_area, day_val, total_val)
         
-        # Добавляем значения в ячейки
-        values = [date, subdivision, operation, culture, day_area, total_area, day_val, total_val]
-        
-        for col, value in zip(columns, values):
-            cell = ws.cell(row=row, column=col)
-            cell.value = value
+        for col, value in enumerate(values, start=2):
+            cell = ws.cell(row=row, column=col, value=value)
             
             # Числовое форматирование для числовых данных
-            if col >= 6:  # Для колонок E-I (числовые данные)
+            if col >= 6 and value:  # Для колонок E-I (числовые данные)
+                if type(value) in (int, float):
+                    cell.value = float(value)
+                    cell.number_format = '#,##0'
+                    continue
                 try:
-                    if value and str(value).strip():
-                        cell.value = float(str(value).replace(",", ".").replace(" ", ""))
-                        cell.number_format = '#,##0'
-                except (ValueError, AttributeError):
+                    cell.value = float(str(value).translate(NUMBER_CLEANUP))
+                    cell.number_format = '#,##0'
+                except ValueError:
                     pass
     
     def normalize_culture_abbreviation(self, culture: str) -> str:
         """Нормализует сокращения культур"""
         if not culture:
             return ""
-            
-        culture_lower = str(culture).lower().strip()
-        
-        # Прямые соответствия сокращений
-        direct_map = {
-            "оз": "Пшеница озимая товарная",
-            "оз.": "Пшеница озимая товарная",
-            "озимая": "Пшеница озимая товарная",
-            "озим": "Пшеница озимая товарная",
-            "пш": "Пшеница озимая товарная",
-            "оз пш": "Пшеница озимая товарная",
-            "мн": "Многолетние травы прошлых лет",
-            "мн.": "Многолетние травы прошлых лет",
-            "мн тр": "Многолетние травы прошлых лет",
-            "многолетн": "Многолетние травы прошлых лет",
-            "сах св": "Свекла сахарная",
-            "сах": "Свекла сахарная",
-            "св": "Свекла сахарная",
-            "свекла": "Свекла сахарная",
-            "соя": "Соя товарная",
-            "сои": "Соя товарная",
-            "зяби": "Зябь",
-            "зябь": "Зябь",
-            "кук": "Кукуруза товарная",
-            "подс": "Подсолнечник товарный",
-            "культ": "Пшеница озимая товарная"
-        }
+        # Значение от YandexGPT может оказаться списком или словарем: в ключ кэша - только строка
+        return self._culture_cached(str(culture))
+    
+    def _normalize_culture_impl(self, culture: str) -> str:
+        """Поиск полного названия культуры (результат кэшируется в _culture_cached)"""
+        culture_lower = culture.lower().strip()
+        
+        # Название уже полное (из справочника)
+        full_name = self._cultures_exact.get(culture_lower)
+        if full_name is not None:
+            return full_name
         
         # Проверка на прямое соответствие
-        if culture_lower in direct_map:
-            return direct_map[culture_lower]
+        if culture_lower in CULTURE_ABBREVIATIONS:
+            return CULTURE_ABBREVIATIONS[culture_lower]
         
         # Проверка на наличие словосочетаний
-        for key, value in direct_map.items():
+        for key, value in CULTURE_ABBREVIATIONS.items():
             if key in culture_lower:
                 return value
         
@@ -900,8 +1317,8 @@ class FileHandler:
                 return full_name
         
         # Если полное название в справочнике
-        for full_name in self.reference_data["cultures"]:
-            if culture_lower in full_name.lower() or full_name.lower() in culture_lower:
+        for full_name_lower, full_name in self._cultures_lower:
+            if culture_lower in full_name_lower or full_name_lower in culture_lower:
                 return full_name
         
         # Логируем неизвестные культуры для дальнейшего анализа
@@ -938,10 +1355,25 @@ class FileHandler:
         """
         try:
             # Очищаем кэш анализа
-            cache_file = os.path.join(self.base_path, "analysis_cache.json")
-            if os.path.exists(cache_file):
-                os.remove(cache_file)
-                logging.info(f"Кэш анализа удален: {cache_file}")
+            with self._analysis_cache_lock:
+                for cache_file in (self.analysis_cache_file, self.legacy_analysis_cache_file):
+                    if os.path.exists(cache_file):
+                        os.remove(cache_file)
+                        logging.info(f"Кэш анализа удален: {cache_file}")
+                self._analysis_cache = None
+                self._analysis_cache_pending = {}
+                self._analysis_cache_lines = 0
+            
+            # Открытые документы Word отбрасываются без сохранения: иначе следующее сообщение
+            # или flush_documents запишут на диск удаляемые при сбросе сообщения
+            with self._doc_lock:
+                self._doc_cache.clear()
+
+            self.gpt_cache.clear()
+            self._parse_cached.cache_clear()
+            self._culture_cached.cache_clear()
+            self._operation_cached.cache_clear()
+            self._recent_messages.clear()
             
             # Сбрасываем счетчики и статистику
             self.message_counters = {}
@@ -950,6 +1382,7 @@ class FileHandler:
                 "senders": {},
                 "fields_data": {}
             }
+            self.data_version += 1
             
             logging.info("Кэш и счетчики очищены")
             return True
@@ -972,16 +1405,12 @@ class FileHandler:
             Dict[str, Any]: результаты анализа или пустой словарь
         """
         try:
-            # Создаем уникальный ключ для сообщения
-            cache_key = f"{len(message_text)}_{hash(message_text) % 10000}"
-            
-            # Пытаемся загрузить кэш
-            cache_file = os.path.join(self.base_path, "analysis_cache.json")
+            # Ключ сообщения: blake2b точного текста, одинаковый между перезапусками
+            cache_key = exact_text_key(message_text)
             
-            if os.path.exists(cache_file):
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    cache_data = json.load(f)
-                    
+            # Пытаемся загрузить кэш (файл читается, только если изменился)
+            with self._analysis_cache_lock:
+                cache_data = self._load_analysis_cache()
                 if cache_key in cache_data:
                     logging.info(f"Найден кэшированный анализ для сообщения")
                     return cache_data[cache_key]
@@ -989,43 +1418,127 @@ class FileHandler:
             # Если кэш не найден, используем базовый парсинг
             result = self.parse_message(message_text)
             
-            # Сохраняем результат в кэш для будущего использования
-            self.save_to_cache(cache_key, result)
+            # Сохраняем результат в кэш для будущего использования; на диск он
+            # записывается один раз в конце update_excel (flush_analysis_cache)
+            self.save_to_cache(cache_key, result, write=False)
             
             return result
         except Exception as e:
             logging.error(f"Ошибка при загрузке кэша анализа: {str(e)}")
             return self.parse_message(message_text)
     
-    def save_to_cache(self, cache_key: str, analysis_result: Dict[str, Any]) -> None:
+    def save_to_cache(self, cache_key: str, analysis_result: Dict[str, Any], write: bool = True) -> None:
         """
         Сохраняет результаты анализа в кэш
         
         Args:
             cache_key (str): ключ кэша
             analysis_result (Dict[str, Any]): результаты анализа
+            write (bool): сразу записать файл кэша; иначе запись откладывается до flush_analysis_cache
         """
         try:
-            cache_file = os.path.join(self.base_path, "analysis_cache.json")
-            
-            # Загружаем существующий кэш или создаем новый
-            if os.path.exists(cache_file):
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    cache_data = json.load(f)
-            else:
-                cache_data = {}
-            
-            # Добавляем новые данные
-            cache_data[cache_key] = analysis_result
-            
-            # Сохраняем обновленный кэш
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f, ensure_ascii=False, indent=2)
+            with self._analysis_cache_lock:
+                # Добавляем новые данные
+                cache_data = self._load_analysis_cache()
+                cache_data[cache_key] = analysis_result
+                self._analysis_cache_pending[cache_key] = analysis_result
+                
+                # Дописываем запись в конец файла кэша
+                if write:
+                    self._append_analysis_cache()
                 
             logging.info(f"Результаты анализа сохранены в кэш")
         except Exception as e:
             logging.error(f"Ошибка при сохранении в кэш: {str(e)}")
     
+    def flush_analysis_cache(self) -> None:
+        """Дописывает на диск отложенные записи кэша анализа"""
+        try:
+            with self._analysis_cache_lock:
+                self._load_analysis_cache()
+                if self._analysis_cache_pending:
+                    self._append_analysis_cache()
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении в кэш: {str(e)}")
+    
+    def _load_analysis_cache(self) -> Dict[str, Any]:
+        """Кэш анализа из памяти или с диска, если файл изменился (под _analysis_cache_lock)"""
+        stamp = self._analysis_cache_stamp()
+        if self._analysis_cache is not None and self._analysis_cache[0] == stamp:
+            return self._analysis_cache[1]
+        
+        cache_data = {}
+        lines = 0
+        damaged = 0
+        if stamp is not None:
+            # Для повторяющегося ключа действует последняя строка
+            with open(self.analysis_cache_file, 'rb') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = orjson.loads(line)
+                        cache_data[entry["k"]] = entry["v"]
+                    except (orjson.JSONDecodeError, KeyError, TypeError):
+                        damaged += 1
+            self._analysis_cache = (stamp, cache_data)
+            self._analysis_cache_lines = lines
+            if damaged:
+                # Недописанная строка (например, после аварийной остановки) склеилась бы
+                # со следующей записью - переписываем файл без поврежденных строк
+                logging.warning("В кэше анализа пропущено поврежденных строк: %d", damaged)
+                self._write_analysis_cache(cache_data)
+        elif os.path.exists(self.legacy_analysis_cache_file):
+            # Переносим кэш из прежнего файла-словаря
+            with open(self.legacy_analysis_cache_file, 'rb') as f:
+                cache_data = orjson.loads(f.read())
+            self._write_analysis_cache(cache_data)
+            os.remove(self.legacy_analysis_cache_file)
+            logging.info("Кэш анализа перенесен в %s (%d записей)", self.analysis_cache_file, len(cache_data))
+        else:
+            self._analysis_cache = (None, cache_data)
+            self._analysis_cache_lines = 0
+        self._analysis_cache_pending = {}
+        return cache_data
+    
+    def _load_analysis_cache_locked(self) -> Dict[str, Any]:
+        """_load_analysis_cache с захватом блокировки (для вызова через asyncio.to_thread)"""
+        with self._analysis_cache_lock:
+            return self._load_analysis_cache()
+    
+    def _analysis_cache_stamp(self) -> Optional[Tuple[int, int]]:
+        """(mtime_ns, размер) файла кэша анализа или None, если файла нет"""
+        try:
+            st = os.stat(self.analysis_cache_file)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+    
+    def _append_analysis_cache(self) -> None:
+        """Дописывает отложенные записи в файл кэша анализа (под _analysis_cache_lock)"""
+        cache_data = self._analysis_cache[1]
+        pending = self._analysis_cache_pending
+        self._analysis_cache_pending = {}
+        
+        # Повторы ключей накапливаются в файле: когда строк вдвое больше, чем записей,
+        # файл переписывается целиком
+        lines = self._analysis_cache_lines + len(pending)
+        if lines > ANALYSIS_CACHE_COMPACT_MIN and lines > 2 * len(cache_data):
+            self._write_analysis_cache(cache_data)
+            return
+        
+        with open(self.analysis_cache_file, 'ab') as f:
+            f.write(b"".join(map(_analysis_cache_line, pending.items())))
+        self._analysis_cache = (self._analysis_cache_stamp(), cache_data)
+        self._analysis_cache_lines = lines
+    
+    def _write_analysis_cache(self, cache_data: Dict[str, Any]) -> None:
+        """Перезаписывает файл кэша анализа по строке на запись (под _analysis_cache_lock)"""
+        with open(self.analysis_cache_file, 'wb') as f:
+            f.write(b"".join(map(_analysis_cache_line, cache_data.items())))
+        self._analysis_cache = (self._analysis_cache_stamp(), cache_data)
+        self._analysis_cache_lines = len(cache_data)
+        self._analysis_cache_pending = {}
+    
     async def analyze_and_cache_message(self, sender_name: str, message_text: str, yandex_gpt) -> Dict[str, Any]:
         """
         Анализирует сообщение с YandexGPT и сохраняет результаты в кэш
@@ -1038,27 +1551,37 @@ class FileHandler:
         Returns:
             Dict[str, Any]: результаты анализа
         """
-        # Создаем уникальный ключ для сообщения
-        cache_key = f"{len(message_text)}_{hash(message_text) % 10000}"
+        # Ключ сообщения: blake2b точного текста, общий для памяти и файла кэша (встроенный
+        # hash() меняется при каждом запуске, а % 10000 давал коллизии). Текст не нормализуется:
+        # от регистра и переносов строк зависит разбор сообщения парсером
+        cache_key = exact_text_key(message_text)
+        cached = self.gpt_cache.get(cache_key)
+        if cached is not None:
+            logging.info("Используется кэшированный анализ (память)")
+            return cached
         
         try:
-            # Проверяем наличие кэша
-            cache_file = os.path.join(self.base_path, "analysis_cache.json")
-            
-            if os.path.exists(cache_file):
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    cache_data = json.load(f)
-                    
-                if cache_key in cache_data:
-                    logging.info(f"Используется кэшированный анализ")
-                    return cache_data[cache_key]
+            # Проверяем наличие кэша: в цикле событий смотрим только копию файла в памяти,
+            # с диска (в отдельном потоке) она читается один раз; изменения файла извне
+            # подхватят load_cached_analysis и save_to_cache
+            analysis_cache = self._analysis_cache
+            if analysis_cache is None:
+                cache_data = await asyncio.to_thread(self._load_analysis_cache_locked)
+            else:
+                cache_data = analysis_cache[1]
+            cached = cache_data.get(cache_key)
+            if cached is not None:
+                logging.info(f"Используется кэшированный анализ")
+                self.gpt_cache.put(cache_key, cached)
+                return cached
             
             # Если в кэше нет, анализируем с YandexGPT
             logging.info(f"Анализируем сообщение с YandexGPT (не найдено в кэше)")
             result = await self.analyze_with_yandex_gpt(message_text, yandex_gpt)
             
-            # Сохраняем результат в кэш
-            self.save_to_cache(cache_key, result)
+            # Сохраняем результат в кэш (запись в файл - в отдельном потоке)
+            self.gpt_cache.put(cache_key, result)
+            await asyncio.to_thread(self.save_to_cache, cache_key, result)
             
             return result
         except Exception as e:
@@ -1093,39 +1616,29 @@ class FileHandler:
         """
         if not operation_abbr:
             return ""
+        return self._operation_cached(str(operation_abbr))
+    
+    def _operation_name_impl(self, operation_abbr: str) -> str:
+        """Поиск полного названия операции (результат кэшируется в _operation_cached)"""
+        operation_lower = operation_abbr.lower()
         
-        # Словарь типичных сокращений операций
-        operation_map = {
-            "пахота": "Пахота",
-            "пах": "Пахота",
-            "диск": "Дискование",
-            "дискование": "Дискование",
-            "диск 2": "Дискование 2-е",
-            "диск 2-е": "Дискование 2-е",
-            "культ": "Культивация",
-            "предп культ": "Предпосевная культивация",
-            "предпосевная": "Предпосевная культивация",
-            "выравнивание": "Выравнивание",
-            "подкормка": "Подкормка",
-            "2-я подкормка": "2-я подкормка",
-            "сев": "Сев",
-            "посев": "Посев",
-            "уборка": "Уборка"
-        }
+        # Название уже полное (из справочника)
+        operation = self._operations_exact.get(operation_lower)
+        if operation is not None:
+            return operation
         
         # Проверяем прямое соответствие
-        operation_lower = operation_abbr.lower()
-        if operation_lower in operation_map:
-            return operation_map[operation_lower]
+        if operation_lower in OPERATION_ABBREVIATIONS:
+            return OPERATION_ABBREVIATIONS[operation_lower]
         
         # Проверяем частичное соответствие
-        for abbr, full_name in operation_map.items():
+        for abbr, full_name in OPERATION_ABBREVIATIONS.items():
             if abbr in operation_lower:
                 return full_name
         
         # Проверяем соответствие в списке стандартных операций
-        for op in self.reference_data["operations"]:
-            if op.lower() in operation_lower or operation_lower in op.lower():
+        for op_lower, op in self._operations_lower:
+            if op_lower in operation_lower or operation_lower in op_lower:
                 return op
         
         # Если не нашли совпадений, возвращаем исходное значение с заглавной буквы
@@ -1141,60 +1654,7 @@ class FileHandler:
         Returns:
             str: Сформированный промпт
         """
-        return f"""Проанализируй сообщение или фотографию от агронома и извлеки структурированную информацию.
-
-Если анализируется фотография:
-1. Определи тип работы (вспашка, сев, уборка и т.д.)
-2. Определи культуру
-3. Оцени качество работы
-4. Опиши состояние поля/культуры
-5. Укажи любые проблемы или особенности, которые видны на фото
-
-Если анализируется текстовое сообщение:
-{message_text}
-
-Верни результат в формате JSON со следующими полями:
-{{
-    "work_type": "тип работы",
-    "operation": "конкретная операция",
-    "culture_from": "исходная культура (если применимо)",
-    "culture_to": "целевая культура (если применимо)", 
-    "pu_number": "номер поля",
-    "pu_area": "площадь в га",
-    "department": "отделение",
-    "quality": "оценка качества работы (если есть фото)",
-    "field_condition": "состояние поля/культуры (если есть фото)",
-    "issues": "обнаруженные проблемы (если есть)"
-}}
-
-Пример анализа текстового сообщения:
-Входное сообщение: "Центральное отделение поле 125 площадь 82 га посев кукурузы"
-{{
-    "work_type": "посев",
-    "operation": "посев",
-    "culture_from": null,
-    "culture_to": "кукуруза",
-    "pu_number": "125",
-    "pu_area": "82",
-    "department": "Центральное отделение",
-    "quality": null,
-    "field_condition": null,
-    "issues": null
-}}
-
-Пример анализа фото:
-{{
-    "work_type": "вспашка",
-    "operation": "вспашка",
-    "culture_from": null,
-    "culture_to": null,
-    "pu_number": null,
-    "pu_area": null,
-    "department": null,
-    "quality": "хорошее",
-    "field_condition": "почва хорошо обработана, без крупных комков",
-    "issues": "небольшие пожнивные остатки на поверхности"
-}}"""
+        return ANALYSIS_PROMPT_HEAD + message_text + ANALYSIS_PROMPT_TAIL
     
     async def analyze_message(self, message_text: str, photo_path: str = None) -> dict:
         """
@@ -6,6 +6,13 @@ from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
 from urllib.parse import urlparse, parse_qs
 
+# Файлы меньше этого размера загружаются одним multipart-запросом: возобновляемая
+# загрузка тратит лишний запрос на открытие сессии
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+# Размер части при возобновляемой загрузке больших файлов
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
 class GoogleDriveUploader:
     def __init__(self, credentials_path: str = None):
         """
@@ -16,13 +23,16 @@ class GoogleDriveUploader:
         """
         self.SCOPES = ['https://www.googleapis.com/auth/drive.file']
         self.service = None
+        # ID папки по URL и папки, доступ к которым уже подтвержден
+        self._folder_id_cache = {}
+        self._folder_access_cache = set()
         
         try:
             # Если предоставлены учетные данные сервисного аккаунта
             if credentials_path and os.path.exists(credentials_path):
                 credentials = service_account.Credentials.from_service_account_file(
                     credentials_path, scopes=self.SCOPES)
-                self.service = build('drive', 'v3', credentials=credentials)
+                self.service = build('drive', 'v3', credentials=credentials, cache_discovery=False)
             else:
                 # Используем стандартную аутентификацию через OAuth
                 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -48,7 +58,7 @@ class GoogleDriveUploader:
                     with open('token.pickle', 'wb') as token:
                         pickle.dump(creds, token)
                 
-                self.service = build('drive', 'v3', credentials=creds)
+                self.service = build('drive', 'v3', credentials=creds, cache_discovery=False)
                 
         except Exception as e:
             logging.error(f"Ошибка при инициализации Google Drive API: {str(e)}")
@@ -64,6 +74,16 @@ class GoogleDriveUploader:
         Returns:
             str: ID папки
         """
+        folder_id = self._folder_id_cache.get(folder_url)
+        if folder_id is not None:
+            return folder_id
+        folder_id = self._parse_folder_id(folder_url)
+        if folder_id:
+            self._folder_id_cache[folder_url] = folder_id
+        return folder_id
+    
+    def _parse_folder_id(self, folder_url: str) -> str:
+        """Разбирает URL папки Google Drive (результат кэшируется в get_folder_id_from_url)"""
         try:
             # Обрабатываем разные форматы URL
             if 'folders' in folder_url:
@@ -93,7 +113,9 @@ class GoogleDriveUploader:
             str: ID загруженного файла или None в случае ошибки
         """
         try:
-            if not os.path.exists(file_path):
+            try:
+                file_size = os.path.getsize(file_path)
+            except OSError:
                 logging.error(f"Файл не найден: {file_path}")
                 return None
             
@@ -109,11 +131,18 @@ class GoogleDriveUploader:
                 'parents': [folder_id]
             }
             
-            # Создаем объект MediaFileUpload
-            media = MediaFileUpload(
-                file_path,
-                resumable=True
-            )
+            # Создаем объект MediaFileUpload (тип отчетов Excel указываем сразу,
+            # остальные файлы определяются по расширению)
+            mimetype = XLSX_MIMETYPE if file_path.endswith('.xlsx') else None
+            if file_size < RESUMABLE_UPLOAD_THRESHOLD:
+                media = MediaFileUpload(file_path, mimetype=mimetype, resumable=False)
+            else:
+                media = MediaFileUpload(
+                    file_path,
+                    mimetype=mimetype,
+                    chunksize=UPLOAD_CHUNK_SIZE,
+                    resumable=True
+                )
             
             # Загружаем файл
             file = self.service.files().create(
@@ -143,9 +172,13 @@ class GoogleDriveUploader:
             folder_id = self.get_folder_id_from_url(folder_url)
             if not folder_id:
                 return False
+            # Доступ уже проверялся; отказ не кэшируется, так как права могут выдать позже
+            if folder_id in self._folder_access_cache:
+                return True
             
             # Пытаемся получить метаданные папки
-            self.service.files().get(fileId=folder_id).execute()
+            self.service.files().get(fileId=folder_id, fields='id').execute()
+            self._folder_access_cache.add(folder_id)
             return True
             
         except Exception as e:
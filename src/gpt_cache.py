@@ -0,0 +1,60 @@
+import hashlib
+from collections import OrderedDict
+from typing import Any, Optional
+
+def exact_text_key(message_text: str) -> str:
+    """
+    Ключ кэша анализа (в памяти и в файле): хеш точного текста сообщения
+
+    Регистр и переносы строк не нормализуются - от них зависит разбор сообщения
+    парсером (ПУ, отделения, валы), поэтому разные по записи тексты не смешиваются
+
+    Args:
+        message_text (str): текст сообщения
+
+    Returns:
+        str: hex-дайджест blake2b
+    """
+    return hashlib.blake2b(message_text.encode("utf-8"), digest_size=16).hexdigest()
+
+class LRUCache:
+    def __init__(self, maxsize: int = 2048):
+        """
+        Кэш в памяти с вытеснением давно не использованных записей
+
+        Args:
+            maxsize (int): максимальное количество записей
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Возвращает значение по ключу или None"""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        """Сохраняет значение, вытесняя самую старую запись при переполнении"""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def discard(self, key: str) -> None:
+        """Удаляет запись, если она есть"""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Очищает кэш"""
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -1,12 +1,114 @@
 import os
 import json
+import threading
+import time
 import requests
 import jwt
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime
+from typing import Optional, Dict, Any, Tuple
 import logging
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
+
+# Разобранные ключи сервисных аккаунтов: путь -> (mtime_ns файла, данные ключа, закрытый ключ).
+# Разбор PEM с проверкой RSA-ключа дорогой, поэтому выполняется только при изменении файла
+_KEY_CACHE: Dict[str, Tuple[int, Dict[str, Any], Any]] = {}
+
+# IAM токен живет до 12 часов: путь к ключу -> (момент истечения по time.monotonic(), токен).
+# Токен обновляется заранее, за IAM_TOKEN_SKEW секунд до истечения
+IAM_TOKEN_LIFETIME = 12 * 60 * 60
+IAM_TOKEN_SKEW = 300
+_TOKEN_CACHE: Dict[str, Tuple[float, str]] = {}
+_TOKEN_LOCK = threading.Lock()
+
+IAM_TOKENS_URL = "https://iam.api.cloud.yandex.net/iam/v1/tokens"
+IAM_TIMEOUT = 30  # Таймаут запроса к IAM API в секундах
+JWT_LIFETIME = 3600  # Срок действия JWT для обмена на IAM токен в секундах
+
+# Сессия для запросов к IAM API: соединение переиспользуется между обновлениями токена,
+# временные ошибки шлюза (502-504) повторяются с задержкой
+_iam_session: Optional[requests.Session] = None
+
+def _get_iam_session() -> requests.Session:
+    """Общая сессия requests для IAM API"""
+    global _iam_session
+    if _iam_session is None:
+        retry = Retry(
+            total=2,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False
+        )
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry))
+        _iam_session = session
+    return _iam_session
+
+def load_service_account_key(sa_key_file: str) -> Tuple[Dict[str, Any], Any]:
+    """
+    Загружает ключ сервисного аккаунта (с кэшированием до изменения файла)
+    
+    Args:
+        sa_key_file (str): путь к файлу с ключом сервисного аккаунта
+        
+    Returns:
+        Tuple[Dict[str, Any], Any]: данные ключа из файла и закрытый ключ RSA
+    """
+    mtime_ns = os.stat(sa_key_file).st_mtime_ns
+    cached = _KEY_CACHE.get(sa_key_file)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1], cached[2]
+    
+    with open(sa_key_file, 'r') as f:
+        sa_key = json.load(f)
+    
+    # Загружаем приватный ключ
+    private_key = serialization.load_pem_private_key(
+        sa_key['private_key'].encode(),
+        password=None
+    )
+    _KEY_CACHE[sa_key_file] = (mtime_ns, sa_key, private_key)
+    return sa_key, private_key
+
+def cached_iam_token(sa_key_file: str, skew: float = IAM_TOKEN_SKEW) -> Optional[str]:
+    """IAM токен из кэша, если до его истечения больше skew секунд, иначе None (без запросов)"""
+    cached = _TOKEN_CACHE.get(sa_key_file)
+    if cached is not None and time.monotonic() < cached[0] - skew:
+        return cached[1]
+    return None
+
+def get_iam_token(sa_key_file: str, rejected_token: Optional[str] = None,
+                  skew: float = IAM_TOKEN_SKEW) -> Optional[str]:
+    """
+    Возвращает IAM токен из кэша или получает новый, если срок действия подходит к концу
+    
+    Args:
+        sa_key_file (str): путь к файлу с ключом сервисного аккаунта
+        rejected_token (Optional[str]): токен, который API отклонил (ответ 401) - если
+            в кэше он же, запрашивается новый
+        skew (float): за сколько секунд до истечения токен считается устаревшим
+        
+    Returns:
+        Optional[str]: IAM токен или None в случае ошибки
+    """
+    token = cached_iam_token(sa_key_file, skew)
+    if token is not None and token != rejected_token:
+        return token
+    
+    # Одновременные запросы за токеном из разных потоков сводятся к одному обращению к IAM
+    with _TOKEN_LOCK:
+        token = cached_iam_token(sa_key_file, skew)
+        if token is not None and token != rejected_token:
+            return token
+        
+        result = _request_iam_token(sa_key_file)
+        if result is None:
+            return None
+        token, lifetime = result
+        _TOKEN_CACHE[sa_key_file] = (time.monotonic() + lifetime, token)
+        return token
 
 def get_service_account_token(sa_key_file: str) -> Optional[str]:
     """
@@ -18,23 +120,36 @@ def get_service_account_token(sa_key_file: str) -> Optional[str]:
     Returns:
         Optional[str]: IAM токен или None в случае ошибки
     """
+    result = _request_iam_token(sa_key_file)
+    return result[0] if result is not None else None
+
+def _token_lifetime(expires_at: Optional[str]) -> float:
+    """Сколько секунд осталось до expiresAt из ответа IAM (RFC 3339, UTC)"""
     try:
-        with open(sa_key_file, 'r') as f:
-            sa_key = json.load(f)
-            
-        # Загружаем приватный ключ
-        private_key = serialization.load_pem_private_key(
-            sa_key['private_key'].encode(),
-            password=None,
-            backend=default_backend()
-        )
+        # Дробная часть секунд (до наносекунд) для расчета не нужна
+        expires = datetime.strptime(expires_at[:19], "%Y-%m-%dT%H:%M:%S")
+        return (expires - datetime.utcnow()).total_seconds()
+    except (TypeError, ValueError):
+        return IAM_TOKEN_LIFETIME
+
+def _request_iam_token(sa_key_file: str) -> Optional[Tuple[str, float]]:
+    """
+    Обменивает подписанный JWT сервисного аккаунта на IAM токен
+    
+    Returns:
+        Optional[Tuple[str, float]]: токен и срок его действия в секундах или None в случае ошибки
+    """
+    try:
+        # Ключ разбирается один раз; в jwt.encode передается готовый объект ключа
+        sa_key, private_key = load_service_account_key(sa_key_file)
             
-        now = datetime.utcnow()
+        # Метки времени JWT - целые секунды Unix, без datetime и его пересчета в PyJWT
+        now = int(time.time())
         payload = {
-            'aud': 'https://iam.api.cloud.yandex.net/iam/v1/tokens',
+            'aud': IAM_TOKENS_URL,
             'iss': sa_key['service_account_id'],
             'iat': now,
-            'exp': now + timedelta(hours=1)
+            'exp': now + JWT_LIFETIME
         }
 
         # Подписываем JWT используя закрытый ключ
@@ -45,14 +160,13 @@ def get_service_account_token(sa_key_file: str) -> Optional[str]:
             headers={'kid': sa_key['id']}
         )
             
-        url = "https://iam.api.cloud.yandex.net/iam/v1/tokens"
-        response = requests.post(url, json={"jwt": encoded_jwt})
+        response = _get_iam_session().post(IAM_TOKENS_URL, json={"jwt": encoded_jwt}, timeout=IAM_TIMEOUT)
         response.raise_for_status()
         
         result = response.json()
         if 'iamToken' in result:
             logging.info("IAM токен успешно получен")
-            return result['iamToken']
+            return result['iamToken'], _token_lifetime(result.get('expiresAt'))
         else:
             logging.error(f"Ошибка в ответе IAM API: {result}")
             return None
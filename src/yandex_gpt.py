@@ -1,58 +1,51 @@
-import json
 import logging
 import os
 import requests
 import aiohttp
+import orjson
 import base64
+import asyncio
+import time
 from typing import Optional, Dict, Any, List
-from .yandex_auth import get_service_account_token
+from .yandex_auth import cached_iam_token, get_iam_token
 
-class YandexGPT:
-    def __init__(self, service_account_key_file: str, folder_id: str):
-        """
-        Инициализация клиента YandexGPT
+# Ожидание слота дольше этого порога (в секундах) считается признаком перегрузки
+SLOW_ACQUIRE_SECONDS = 0.1
 
-        Args:
-            service_account_key_file (str): путь к файлу с ключом сервисного аккаунта
-            folder_id (str): идентификатор каталога в Яндекс Облаке
-        """
-        self.service_account_key_file = service_account_key_file
-        self.folder_id = folder_id
-        self.token = get_service_account_token(service_account_key_file)
-        self.base_url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
-        self.vision_url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
-        self.headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
-        }
-        # Доступные модели
-        self.models = {
-            "lite": "yandexgpt-lite",    # Облегченная версия
-            "full": "yandexgpt",         # Полная версия
-            "text": "yandexgpt",         # Используем полную версию для текста
-            "vision": "yandexgpt"        # Используем полную версию для изображений
-        }
+# Общий таймаут одного запроса к API (секунды) и время жизни простаивающего соединения
+REQUEST_TIMEOUT = 60
+KEEPALIVE_TIMEOUT = 75
+# Таймаут установки нового TCP-соединения: зависшее подключение не держит слот весь REQUEST_TIMEOUT
+CONNECT_TIMEOUT = 5
 
-    async def generate_response(self, prompt: str, model: str = "full", image_path: str = None) -> dict:
-        """
-        Генерирует ответ от YandexGPT API
-        
-        Args:
-            prompt (str): Текст запроса
-            model (str): Название модели (по умолчанию "full" - полная версия)
-            image_path (str): Путь к изображению (если есть)
-            
-        Returns:
-            dict: Ответ от API
-        """
-        try:
-            if model == "vision" and not image_path:
-                raise ValueError("Image path is required for vision model")
+# Временные ошибки API (лимит запросов, сбои шлюза) повторяются в той же сессии
+# с экспоненциальной задержкой RETRY_BACKOFF * 2**попытка секунд
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.3
 
-            url = self.vision_url if model == "vision" else self.base_url
-            
-            # Базовый промпт для анализа текстовых сообщений
-            base_prompt = """ПРАВИЛА АНАЛИЗА:
+# Изображения больше этого размера (байт) кодируются в base64 в отдельном потоке,
+# чтобы не задерживать цикл событий
+INLINE_ENCODE_LIMIT = 256 * 1024
+
+# Параметры генерации, общие для всех запросов (словарь не изменяется)
+COMPLETION_OPTIONS = {
+    "stream": False,
+    "temperature": 0.6,
+    "maxTokens": 8000
+}
+
+def _read_bytes(path: str) -> bytes:
+    """Читает файл целиком"""
+    with open(path, "rb") as f:
+        return f.read()
+
+def _encode_image(image_bytes: bytes) -> str:
+    """Содержимое изображения в base64 для поля attachments"""
+    return base64.b64encode(image_bytes).decode('ascii')
+
+# Базовый промпт для анализа текстовых сообщений (если промпт запроса пустой)
+BASE_PROMPT = """ПРАВИЛА АНАЛИЗА:
 
 1. Структура данных:
    - Дата: формат день/месяц/год (30/11/24), если год не указан - текущий год, если дата не указана - дата отправки сообщения
@@ -218,61 +211,181 @@ class YandexGPT:
 
 Проанализируйте предоставленный текст и выделите операции согласно этим правилам."""
 
+class YandexGPT:
+    def __init__(self, service_account_key_file: str, folder_id: str, max_concurrency: int = 8):
+        """
+        Инициализация клиента YandexGPT
+
+        Args:
+            service_account_key_file (str): путь к файлу с ключом сервисного аккаунта
+            folder_id (str): идентификатор каталога в Яндекс Облаке
+            max_concurrency (int): максимальное число одновременных запросов к API
+        """
+        self.service_account_key_file = service_account_key_file
+        self.folder_id = folder_id
+        self.token = get_iam_token(service_account_key_file)
+        self.base_url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+        self.vision_url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+        self.headers = {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json"
+        }
+        # Ограничение одновременных запросов к API и счетчик долгих ожиданий слота
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.slow_acquires = 0
+        # Сессия HTTP создается при первом запросе (нужен запущенный цикл событий) и
+        # переиспользуется: соединения с API остаются открытыми между запросами
+        self.max_concurrency = max_concurrency
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Доступные модели
+        self.models = {
+            "lite": "yandexgpt-lite",    # Облегченная версия
+            "full": "yandexgpt",         # Полная версия
+            "text": "yandexgpt",         # Используем полную версию для текста
+            "vision": "yandexgpt"        # Используем полную версию для изображений
+        }
+        # URI моделей для запроса собираются один раз
+        self.model_uris = {name: f"gpt://{folder_id}/{uri}" for name, uri in self.models.items()}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Общая сессия HTTP с пулом соединений к API"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, sock_connect=CONNECT_TIMEOUT)
+            )
+        return self._session
+    
+    async def close(self) -> None:
+        """Закрывает сессию HTTP и ее соединения"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def __aenter__(self) -> "YandexGPT":
+        return self
+    
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+    
+    async def _update_token(self, rejected_token: Optional[str] = None) -> None:
+        """
+        Обновляет IAM токен в заголовках, если он устарел или был отклонен API.
+        Действующий токен берется из кэша без запросов; новый запрашивается в отдельном потоке
+        """
+        token = None if rejected_token else cached_iam_token(self.service_account_key_file)
+        if token is None:
+            token = await asyncio.to_thread(get_iam_token, self.service_account_key_file, rejected_token)
+        if token and token != self.token:
+            self.token = token
+            self.headers["Authorization"] = f"Bearer {token}"
+    
+    async def generate_response(self, prompt: str, model: str = "full", image_path: str = None,
+                                image_bytes: bytes = None) -> dict:
+        """
+        Генерирует ответ от YandexGPT API
+        
+        Args:
+            prompt (str): Текст запроса
+            model (str): Название модели (по умолчанию "full" - полная версия)
+            image_path (str): Путь к изображению (если есть)
+            image_bytes (bytes): Содержимое изображения в памяти (вместо image_path)
+            
+        Returns:
+            dict: Ответ от API
+        """
+        try:
+            if model == "vision" and not image_path and not image_bytes:
+                raise ValueError("Image path or bytes are required for vision model")
+
+            url = self.vision_url if model == "vision" else self.base_url
+            
             # Используем предоставленный промпт или базовый
-            final_prompt = prompt.strip() if prompt and prompt.strip() else base_prompt
+            final_prompt = (prompt.strip() if prompt else "") or BASE_PROMPT
 
             if model == "vision":
-                with open(image_path, "rb") as image_file:
-                    image_content = base64.b64encode(image_file.read()).decode('utf-8')
+                # Чтение файла и кодирование большого изображения - блокирующая работа
+                if image_bytes is None:
+                    image_bytes = await asyncio.to_thread(_read_bytes, image_path)
+                if len(image_bytes) > INLINE_ENCODE_LIMIT:
+                    image_content = await asyncio.to_thread(_encode_image, image_bytes)
+                else:
+                    image_content = _encode_image(image_bytes)
                 
-                payload = {
-                    "modelUri": f"gpt://{self.folder_id}/{self.models[model]}",
-                    "completionOptions": {
-                        "stream": False,
-                        "temperature": 0.6,
-                        "maxTokens": 8000
-                    },
-                    "messages": [{
-                        "role": "user",
-                        "text": final_prompt,
-                        "attachments": [{
-                            "content": image_content,
-                            "mime_type": "image/jpeg"
-                        }]
+                message = {
+                    "role": "user",
+                    "text": final_prompt,
+                    "attachments": [{
+                        "content": image_content,
+                        "mime_type": "image/jpeg"
                     }]
                 }
+                # Исходные байты и отдельная ссылка на base64 больше не нужны: запрос может
+                # долго ждать слота и ответа, не держим лишние копии изображения
+                del image_bytes, image_content
                 
-                logging.info(f"Отправляем запрос на анализ изображения с промптом длиной {len(final_prompt)} символов")
+                logging.info("Отправляем запрос на анализ изображения с промптом длиной %d символов", len(final_prompt))
             else:
-                payload = {
-                    "modelUri": f"gpt://{self.folder_id}/{self.models[model]}",
-                    "completionOptions": {
-                        "stream": False,
-                        "temperature": 0.6,
-                        "maxTokens": 8000
-                    },
-                    "messages": [{
-                        "role": "user",
-                        "text": final_prompt
-                    }]
+                message = {
+                    "role": "user",
+                    "text": final_prompt
                 }
+            
+            # Постоянные части запроса подготовлены заранее, меняется только сообщение
+            payload = {
+                "modelUri": self.model_uris[model],
+                "completionOptions": COMPLETION_OPTIONS,
+                "messages": [message]
+            }
 
-            logging.info(f"Sending request to {url}")
-            logging.debug(f"Payload structure: {json.dumps({k: '...' if k == 'messages' else v for k, v in payload.items()})}")
+            logging.info("Sending request to %s", url)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("Payload structure: %s", orjson.dumps({k: '...' if k == 'messages' else v for k, v in payload.items()}).decode())
 
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=self.headers, json=payload) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        logging.info("Successfully received response from API")
-                        return result
-                    else:
+            wait_started = time.monotonic()
+            async with self.semaphore:
+                waited = time.monotonic() - wait_started
+                if waited > SLOW_ACQUIRE_SECONDS:
+                    self.slow_acquires += 1
+                    logging.warning("Ожидание свободного слота YandexGPT: %.2f с", waited)
+                
+                await self._update_token()
+                # Повторные попытки: один раз после отказа в токене (401) и при временных
+                # ошибках из RETRY_STATUSES, всего не больше RETRY_ATTEMPTS запросов.
+                # Тело запроса сериализуется один раз (и для повторов) через orjson
+                session = self._get_session()
+                body = orjson.dumps(payload)
+                # Дальше нужно только сериализованное тело; base64 изображения освобождается
+                del payload, message
+                token_refreshed = False
+                for attempt in range(RETRY_ATTEMPTS):
+                    async with session.post(url, headers=self.headers, data=body) as response:
+                        if response.status == 200:
+                            result = orjson.loads(await response.read())
+                            logging.info("Successfully received response from API")
+                            return result
+                        last_attempt = attempt == RETRY_ATTEMPTS - 1
+                        if response.status == 401 and not token_refreshed and not last_attempt:
+                            logging.warning("IAM токен отклонен API, запрашиваем новый")
+                            token_refreshed = True
+                            await self._update_token(rejected_token=self.token)
+                            continue
                         error_text = await response.text()
-                        logging.error(f"Error from API: {error_text}")
-                        return {"error": f"API returned status code {response.status}: {error_text}"}
+                        if response.status not in RETRY_STATUSES or last_attempt:
+                            logging.error("Error from API: %s", error_text)
+                            return {"error": f"API returned status code {response.status}: {error_text}"}
+                    # Тело ответа прочитано, соединение вернулось в пул и будет использовано повторно
+                    delay = RETRY_BACKOFF * 2 ** attempt
+                    logging.warning("API вернул %d, повтор через %.1f с", response.status, delay)
+                    await asyncio.sleep(delay)
                         
         except Exception as e:
-            logging.error(f"Error generating response: {str(e)}")
+            logging.error("Error generating response: %s", e)
             return {"error": str(e)}
 
     def get_response_text(self, response: Dict[str, Any]) -> str:
@@ -280,12 +393,24 @@ class YandexGPT:
         Извлекает текст ответа из результата API
         """
         if "error" in response:
-            logging.error(f"Ошибка в ответе API: {response['error']}")
+            logging.error("Ошибка в ответе API: %s", response['error'])
             return f"Произошла ошибка: {response['error']}"
         
         try:
-            logging.info(f"Обрабатываем ответ от YandexGPT: {json.dumps(response, ensure_ascii=False)[:200]}...")
+            # Превью ответа сериализуется, только если INFO действительно пишется в лог
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logging.info("Обрабатываем ответ от YandexGPT: %s...", orjson.dumps(response).decode()[:200])
+            
+            # Обычный ответ: текст берется напрямую, без промежуточных проверок
+            try:
+                text = response["result"]["alternatives"][0]["message"]["text"]
+            except (KeyError, IndexError, TypeError):
+                text = None
+            if text:
+                logging.info("Успешно получен ответ от YandexGPT длиной %d символов", len(text))
+                return text
             
+            # Иначе выясняем, какой части ответа не хватает
             result = response.get("result", {})
             if not result:
                 logging.error("В ответе отсутствует ключ 'result'")
@@ -306,54 +431,54 @@ class YandexGPT:
                 logging.error("В ответе отсутствует текст")
                 return "Не удалось получить ответ: отсутствует текст"
                 
-            logging.info(f"Успешно получен ответ от YandexGPT длиной {len(text)} символов")
+            logging.info("Успешно получен ответ от YandexGPT длиной %d символов", len(text))
             return text
         except Exception as e:
-            logging.error(f"Ошибка при обработке ответа: {str(e)}")
+            logging.error("Ошибка при обработке ответа: %s", e)
             return f"Ошибка при обработке ответа: {str(e)}"
 
-if __name__ == "__main__":
-    # Пример использования
-    import os
-    
-    # Получаем необходимые параметры
-    sa_key_file = os.getenv('YANDEX_SA_KEY_FILE', 'service-account-key.json')
-    folder_id = os.getenv('YANDEX_FOLDER_ID')
-    
-    if not os.path.exists(sa_key_file):
-        print(f"Ошибка: Файл с ключом сервисного аккаунта не найден: {sa_key_file}")
-        exit(1)
-    
-    if not folder_id:
-        print("Ошибка: Установите переменную окружения YANDEX_FOLDER_ID")
-        exit(1)
-    
-    # Создаем экземпляр YandexGPT
-    gpt = YandexGPT(sa_key_file, folder_id)
-    
-    # Примеры использования разных моделей
+async def _demo(sa_key_file: str, folder_id: str) -> None:
+    """Пример использования: запросы к разным моделям выполняются параллельно"""
     prompts = [
         ("Напиши стихотвореие маяковского", "lite"),
         ("Объясни, что такое квантовая механика простыми словами", "full"),
         ("""Напиши функцию на Python для поиска простых чисел в диапазоне.
         Добавь комментарии и пример использования.""", "full")
     ]
-
-    for prompt, model in prompts:
-        print(f"\nЗапрос к модели {model}:")
-        print("-" * 50)
-        print(f"Промпт: {prompt}")
-        try:
-            result = gpt.generate_response(
+    
+    async with YandexGPT(sa_key_file, folder_id) as gpt:
+        results = await asyncio.gather(
+            *(gpt.generate_response(
                 prompt=prompt,
                 model=model,
                 image_path="path_to_image.jpg" if model == "vision" else None
-            )
-            
-            if result:
+            ) for prompt, model in prompts),
+            return_exceptions=True
+        )
+        
+        for (prompt, model), result in zip(prompts, results):
+            print(f"\nЗапрос к модели {model}:")
+            print("-" * 50)
+            print(f"Промпт: {prompt}")
+            if isinstance(result, Exception):
+                print(f"Ошибка при выполнении запроса: {result}")
+            elif result:
                 print("\nОтвет:")
                 print(gpt.get_response_text(result))
             else:
                 print("Не удалось получить ответ от API")
-        except Exception as e:
-            print(f"Ошибка при выполнении запроса: {e}") 
\ No newline at end of file
+
+if __name__ == "__main__":
+    # Получаем необходимые параметры
+    sa_key_file = os.getenv('YANDEX_SA_KEY_FILE', 'service-account-key.json')
+    folder_id = os.getenv('YANDEX_FOLDER_ID')
+    
+    if not os.path.exists(sa_key_file):
+        print(f"Ошибка: Файл с ключом сервисного аккаунта не найден: {sa_key_file}")
+        exit(1)
+    
+    if not folder_id:
+        print("Ошибка: Установите переменную окружения YANDEX_FOLDER_ID")
+        exit(1)
+    
+    asyncio.run(_demo(sa_key_file, folder_id))